@@ -301,6 +301,1319 @@ assert(elephant.at[2].round(3) == 0.419)
 elephant.plot()
 
 
+# ## Step 7: A Columnar Cache of the CSV File
+# 
+# Every time this notebook runs, `pd.read_csv` parses the whole text file again and guesses the type of every column, even though we only use a few of the columns. Parsing text is slow compared to reading numbers that are already stored in binary.
+# 
+# `load_lmwpid` parses the CSV file only once and saves each column as its own NumPy `.npy` file in a cache folder next to the CSV file. Text columns like `country` and `contcod` are saved as small integer codes together with the list of distinct strings. A `meta.json` file in the folder records the size, modification time and a hash of the CSV file it was made from. If the CSV file has a different size or modification time later on, its hash is compared again, and the cache is rebuilt only if the contents really changed. A rebuild removes the old `meta.json` before it overwrites any column and writes the new one last, so a rebuild that stops partway is never mistaken for a finished cache.
+# 
+# Loading from the cache reads only the columns we ask for, and the `.npy` files are memory mapped, so columns we don't touch are never read from disk. `read_columns` hands back the columns as NumPy arrays, and `load_lmwpid` puts them into a DataFrame that looks just like the one from `pd.read_csv`.
+
+# In[ ]:
+
+
+import os
+import json
+import hashlib
+import numpy as np
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def build_cache(path, folder):
+    table = pd.read_csv(path)
+    os.makedirs(folder, exist_ok=True)
+    # A cache is only used while it has a meta.json, so the old one goes before any column is overwritten
+    meta_path = os.path.join(folder, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    columns = {}
+    for name in table.columns:
+        column = table[name]
+        if pd.api.types.is_object_dtype(column) or pd.api.types.is_string_dtype(column):
+            # Store text as integer codes into the list of distinct strings
+            categories = pd.Categorical(column)
+            np.save(os.path.join(folder, name + '.npy'), np.asarray(categories.codes))
+            np.save(os.path.join(folder, name + '.categories.npy'), np.asarray(categories.categories, dtype=str))
+            columns[name] = 'text'
+        else:
+            np.save(os.path.join(folder, name + '.npy'), column.values)
+            columns[name] = str(column.dtype)
+
+    # meta.json is written last, and renamed into place whole, so a cache that was only partly written is never used
+    stat = os.stat(path)
+    meta = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': file_hash(path),
+            'rows': len(table), 'columns': columns}
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(meta_path + '.tmp', meta_path)
+    return meta
+
+
+def open_cache(path, folder=None):
+    if folder is None:
+        folder = path + '.cache'
+    meta_path = os.path.join(folder, 'meta.json')
+    if not os.path.exists(meta_path):
+        return folder, build_cache(path, folder)
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    # A changed size or modification time means we have to check the contents
+    stat = os.stat(path)
+    if stat.st_size != meta['size'] or stat.st_mtime_ns != meta['mtime']:
+        if stat.st_size != meta['size'] or file_hash(path) != meta['hash']:
+            return folder, build_cache(path, folder)
+        meta['mtime'] = stat.st_mtime_ns
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f, indent=1)
+    return folder, meta
+
+
+def read_columns(path='LMWPIDweb.csv', columns=None, folder=None):
+    folder, meta = open_cache(path, folder)
+    data = {}
+    for name in columns or list(meta['columns']):
+        if name not in meta['columns']:
+            raise KeyError('%s has no column %r' % (path, name))
+        values = np.load(os.path.join(folder, name + '.npy'), mmap_mode='r')
+        if meta['columns'][name] == 'text':
+            categories = np.load(os.path.join(folder, name + '.categories.npy'))
+            values = pd.Categorical.from_codes(values, categories)
+        data[name] = values
+    return data
+
+
+def load_lmwpid(path='LMWPIDweb.csv', columns=None, folder=None):
+    data = read_columns(path, columns, folder)
+    # Text columns come back as plain strings, like pd.read_csv gives them
+    return pd.DataFrame({name: np.asarray(values, dtype=object) if isinstance(values, pd.Categorical) else np.array(values)
+                         for name, values in data.items()})
+
+
+# In[ ]:
+
+
+'''The cached table should be the same as the one read by pd.read_csv'''
+pd.testing.assert_frame_equal(load_lmwpid(), lmwpid)
+pd.testing.assert_frame_equal(load_lmwpid(columns=['bin_year', 'mysample', 'pop', 'RRinc', 'contcod']),
+                              lmwpid[['bin_year', 'mysample', 'pop', 'RRinc', 'contcod']])
+
+'''Changing the CSV file should rebuild the cache, but only touching it should not'''
+import shutil
+import tempfile
+folder = tempfile.mkdtemp()
+copy = os.path.join(folder, 'copy.csv')
+shutil.copy('LMWPIDweb.csv', copy)
+assert(len(load_lmwpid(copy, ['RRinc'])) == len(lmwpid))
+built = os.stat(os.path.join(copy + '.cache', 'RRinc.npy')).st_mtime_ns
+
+os.utime(copy, (0, 0))
+assert(len(load_lmwpid(copy, ['RRinc'])) == len(lmwpid))
+assert(os.stat(os.path.join(copy + '.cache', 'RRinc.npy')).st_mtime_ns == built)
+
+lmwpid.iloc[:100].to_csv(copy, index=False)
+assert(len(load_lmwpid(copy, ['RRinc'])) == 100)
+
+'''A rebuild that stops partway leaves no meta.json behind, so the old cache is never used again'''
+os.remove(os.path.join(copy + '.cache', 'pop.npy'))
+os.mkdir(os.path.join(copy + '.cache', 'pop.npy'))
+try:
+    build_cache(copy, copy + '.cache')
+    assert(False)
+except OSError:
+    assert(not os.path.exists(os.path.join(copy + '.cache', 'meta.json')))
+shutil.rmtree(folder)
+
+
+# Reading the five columns we need from the cache, compared to parsing the CSV file:
+
+# In[ ]:
+
+
+import time
+
+start = time.perf_counter()
+pd.read_csv('LMWPIDweb.csv')
+print('read_csv:   %.2f ms' % ((time.perf_counter() - start)*1000))
+
+start = time.perf_counter()
+load_lmwpid(columns=['bin_year', 'mysample', 'pop', 'RRinc', 'contcod'])
+print('from cache: %.2f ms' % ((time.perf_counter() - start)*1000))
+
+
+# ## Step 8: A Smaller Table in Memory
+# 
+# `pd.read_csv` stores every number as a 64 bit `int64` or `float64`, and every piece of text as its own Python string, so a country name is stored again in every decile row of every year. That is fine for this table, but the full panel together with larger survey data quickly fills up memory.
+# 
+# `compact_lmwpid` stores each column with a smaller type, following `lmwpid_schema`: the years, decile groups and `mysample` as small integers, `pop`, `RRinc` and the other amounts as 32 bit floats, and `country`, `contcod` and `region` as categoricals, which keep each distinct string once and store a small integer code per row. A column is only made smaller if nothing is lost: integer columns have to hold whole numbers that fit the smaller type, and a float32 column has to stay within a relative difference of `rtol` of the original values. Columns that are not in the schema are left alone. `load_lmwpid(compact=True)` does the same while loading from the cache, and keeps the text columns as categoricals straight from their stored codes. `memory_report` compares the memory used by each column before and after.
+# 
+# `quantile_means` does Steps 1 to 4 for any year, `mysample` and number of buckets, so we can check that the smaller table gives the same elephant curve. It adds up the running population in 64 bit floats even when `pop` is stored as float32, since rounding errors would otherwise pile up along the cumulative sum and could move a record across a bucket boundary. It also sorts with a stable sort, so records with the same RRinc stay in the order of the file. The default sort can put equal values in a different order depending on the type RRinc is stored as, which can move a record into a different bucket.
+
+# In[ ]:
+
+
+lmwpid_schema = {'bin_year': 'int16', 'year': 'int16', 'group': 'int8', 'mysample': 'int8',
+                 'pop': 'float32', 'totpop': 'float32', 'RRinc': 'float32', 'LCU2005': 'float32',
+                 'country': 'category', 'contcod': 'category', 'region': 'category'}
+
+def compact_lmwpid(table, schema=None, rtol=1e-6):
+    if schema is None:
+        schema = lmwpid_schema
+    columns = {}
+    for name in table.columns:
+        column = table[name]
+        kind = schema.get(name)
+        if kind == 'category':
+            column = column.astype('category')
+        elif kind is not None and pd.api.types.is_numeric_dtype(column):
+            small = np.dtype(kind)
+            values = column.values
+            if small.kind == 'i':
+                # Whole numbers that fit into the smaller integer type
+                limits = np.iinfo(small)
+                if column.notna().all() and (values == np.round(values)).all() and limits.min <= values.min() and values.max() <= limits.max:
+                    column = column.astype(small)
+            elif np.allclose(values.astype(small), values, rtol=rtol, atol=0, equal_nan=True):
+                column = column.astype(small)
+        columns[name] = column
+    return pd.DataFrame(columns)
+
+
+def load_lmwpid(path='LMWPIDweb.csv', columns=None, folder=None, compact=False):
+    data = read_columns(path, columns, folder)
+    if compact:
+        # Text columns stay categorical, built straight from their stored codes
+        return compact_lmwpid(pd.DataFrame({name: values if isinstance(values, pd.Categorical) else np.array(values)
+                                            for name, values in data.items()}))
+    # Text columns come back as plain strings, like pd.read_csv gives them
+    return pd.DataFrame({name: np.asarray(values, dtype=object) if isinstance(values, pd.Categorical) else np.array(values)
+                         for name, values in data.items()})
+
+
+def memory_report(before, after):
+    report = pd.DataFrame({'before': before.memory_usage(deep=True), 'after': after.memory_usage(deep=True)})
+    report.loc['total'] = report.sum()
+    report['dtype before'] = before.dtypes.astype(str)
+    report['dtype after'] = after.dtypes.astype(str)
+    report['saved'] = 1 - report['after']/report['before']
+    return report
+
+
+def quantile_means(table, year, mysample=1, bins=20):
+    # Steps 1 to 4: mean RRinc of each bucket of about the same population
+    lm = table.loc[(table['bin_year'] == year) & (table['mysample'] == mysample), ['pop', 'RRinc']]
+    lm = lm.sort_values('RRinc', kind='mergesort')
+    lm['runningpop'] = lm['pop'].astype(np.float64).cumsum()
+    lm['quintile'] = pd.cut(lm['runningpop'], bins=bins, labels=False)
+    return lm['RRinc'].astype(np.float64).groupby(lm['quintile']).mean()
+
+
+# In[ ]:
+
+
+small = load_lmwpid(compact=True)
+memory_report(lmwpid, small)
+
+
+# In[ ]:
+
+
+'''The compact table should have the smaller types'''
+assert(small['bin_year'].dtype == np.int16 and small['group'].dtype == np.int8 and small['mysample'].dtype == np.int8)
+assert(small['pop'].dtype == np.float32 and small['RRinc'].dtype == np.float32)
+assert(small['contcod'].dtype.name == 'category' and small['country'].dtype.name == 'category')
+assert(memory_report(lmwpid, small).at['total', 'after'] < memory_report(lmwpid, small).at['total', 'before']/2)
+pd.testing.assert_frame_equal(compact_lmwpid(lmwpid), small)
+
+'''but the same values'''
+assert((small['contcod'].astype(object) == lmwpid['contcod']).all() and (small['RRinc'] == lmwpid['RRinc']).all())
+assert(np.allclose(small['pop'], lmwpid['pop'], rtol=1e-6, atol=0))
+
+'''and give the same elephant curve'''
+for mysample in [0, 1]:
+    for year in [1988, 1993, 1998, 2003, 2008]:
+        assert(np.allclose(quantile_means(small, year, mysample), quantile_means(lmwpid, year, mysample), rtol=1e-6))
+elephant_small = (quantile_means(small, 2008) - quantile_means(small, 1988))/quantile_means(small, 1988)
+assert(np.allclose(elephant_small, (quantile_means(lmwpid, 2008) - quantile_means(lmwpid, 1988))/quantile_means(lmwpid, 1988)))
+
+'''Columns are only made smaller when nothing is lost'''
+lossy = compact_lmwpid(pd.DataFrame({'group': [1, 2, 300], 'pop': [1.0, 2.0, 1e-50], 'year': [1988.5, 1993, 1998]}))
+assert(lossy['group'].dtype == np.int64 and lossy['pop'].dtype == np.float64 and lossy['year'].dtype == np.float64)
+
+
+# ## Step 9: Splitting the Table by Year Once
+# 
+# Every time we pick out one year, as in Steps 1 and 5, pandas compares every row of the whole table with the year and with `mysample`, builds two masks as long as the table, and copies the matching rows. Then Step 2 sorts those rows by RRinc all over again.
+# 
+# A `YearIndex` does this work once. It sorts the whole table by `bin_year`, then `mysample`, then RRinc with a stable sort (`np.lexsort`), keeps each column we need as a NumPy array in that order, and remembers where the rows of each (`bin_year`, `mysample`) pair start and stop. Fetching the rows of a year is then just a slice of those arrays, which NumPy hands back as a view without copying anything, and the rows are already sorted by RRinc, so the sort in Step 2 is not needed any more.
+# 
+# `YearIndex.quantile_means` does Steps 2 to 4 on such a slice and gives the same result as `quantile_means` from Step 8.
+
+# In[ ]:
+
+
+class YearIndex:
+    def __init__(self, table, columns=('pop', 'RRinc')):
+        year = np.asarray(table['bin_year'])
+        sample = np.asarray(table['mysample'])
+        order = np.lexsort((np.asarray(table['RRinc']), sample, year))
+        self.columns = {name: np.asarray(table[name])[order] for name in columns}
+
+        # Rows of each (bin_year, mysample) pair are next to each other after sorting
+        year, sample = year[order], sample[order]
+        start = np.flatnonzero(np.r_[True, (year[1:] != year[:-1]) | (sample[1:] != sample[:-1])])
+        stop = np.r_[start[1:], len(order)]
+        self.offsets = {(int(year[a]), int(sample[a])): (a, b) for a, b in zip(start, stop)}
+        self.digest = None
+
+    def fingerprint(self):
+        # A blake2b hash of the sorted columns, worked out the first time it is asked for
+        if self.digest is None:
+            h = hashlib.blake2b(digest_size=16)
+            for name in sorted(self.columns):
+                h.update(name.encode())
+                h.update(np.ascontiguousarray(self.columns[name]).tobytes())
+            h.update(repr(sorted(self.offsets.items())).encode())
+            self.digest = h.hexdigest()
+        return self.digest
+
+    def rows(self, year, mysample=1):
+        if (year, mysample) not in self.offsets:
+            raise KeyError('no rows for bin_year %r and mysample %r' % (year, mysample))
+        return self.offsets[(year, mysample)]
+
+    def get(self, year, mysample=1, column='RRinc'):
+        a, b = self.rows(year, mysample)
+        return self.columns[column][a:b]
+
+    def frame(self, year, mysample=1):
+        return pd.DataFrame({name: self.get(year, mysample, name) for name in self.columns})
+
+    def quantile_means(self, year, mysample=1, bins=20):
+        runningpop = np.cumsum(self.get(year, mysample, 'pop'), dtype=np.float64)
+        quintile = pd.cut(runningpop, bins=bins, labels=False)
+        # Mean RRinc of each bucket, leaving out empty buckets like groupby does
+        count = np.bincount(quintile, minlength=bins)
+        total = np.bincount(quintile, weights=self.get(year, mysample, 'RRinc'), minlength=bins)
+        kept = np.flatnonzero(count)
+        return pd.Series(total[kept]/count[kept], index=pd.Index(kept, name='quintile'), name='RRinc')
+
+
+# In[ ]:
+
+
+index = YearIndex(small)
+
+'''Every year should hold the same rows as the masks in Step 1, already sorted by RRinc'''
+for mysample in [0, 1]:
+    for year in [1988, 1993, 1998, 2003, 2008]:
+        rows = lmwpid.loc[(lmwpid['bin_year'] == year) & (lmwpid['mysample'] == mysample), ['pop', 'RRinc']]
+        rows = rows.sort_values('RRinc', kind='mergesort')
+        assert(np.array_equal(index.get(year, mysample, 'RRinc'), rows['RRinc']))
+        assert(np.allclose(index.get(year, mysample, 'pop'), rows['pop'], rtol=1e-6))
+        means = index.quantile_means(year, mysample, 20)
+        assert(means.index.equals(quantile_means(small, year, mysample, 20).index))
+        assert(np.allclose(means, quantile_means(small, year, mysample, 20), rtol=1e-6))
+assert(index.rows(1988, 1)[1] - index.rows(1988, 1)[0] == len(lm1988))
+
+'''Fetching a year does not copy anything'''
+assert(np.shares_memory(index.get(1988), index.columns['RRinc']))
+
+
+# Picking out a year with masks and sorting it, compared to the index:
+
+# In[ ]:
+
+
+start = time.perf_counter()
+for k in range(100):
+    lmwpid.loc[(lmwpid['bin_year'] == 1988) & (lmwpid['mysample'] == 1), ['pop', 'RRinc']].sort_values('RRinc')
+print('masks and sort: %.3f ms' % ((time.perf_counter() - start)*10))
+
+start = time.perf_counter()
+for k in range(100):
+    index.get(1988, 1, 'pop'), index.get(1988, 1, 'RRinc')
+print('index:          %.3f ms' % ((time.perf_counter() - start)*10))
+
+
+# ## Step 10: Elephant Curves for Every Pair of Years
+# 
+# Steps 1 to 6 compare 1988 with 2008, and doing the same for another pair of years means copying all of the steps again. With five years there are ten pairs, and two values of `mysample` and several numbers of buckets on top of that, but each year only needs its bucket table worked out once.
+# 
+# `quantile_tables` works out the tables of several years at once. It takes the rows of all of the years from the `YearIndex` of Step 9, which are already sorted by RRinc, into one DataFrame, and uses `groupby('bin_year')` to add up the running population and cut it into buckets separately for each year. A final `groupby` on the year and the bucket gives the mean RRinc of every bucket of every year in one table, with a column for each year.
+# 
+# `elephant_curves(years, mysample, bins)` then hands that table to `pair_curves`, which takes every pair of years from it and divides, giving a DataFrame with one column for each pair, labeled (`from`, `to`). Given a list of bucket counts instead of one, it gives back a dictionary with one such DataFrame for each count.
+
+# In[ ]:
+
+
+from itertools import combinations
+
+def quantile_tables(index, years, mysample=1, bins=20):
+    # Rows of all of the years together, each year already sorted by RRinc
+    rows = [index.rows(year, mysample) for year in years]
+    take = np.concatenate([np.arange(a, b) for a, b in rows])
+    frame = pd.DataFrame({'bin_year': np.repeat(years, [b - a for a, b in rows]),
+                          'pop': index.columns['pop'][take].astype(np.float64),
+                          'RRinc': index.columns['RRinc'][take].astype(np.float64)})
+
+    # Steps 2 to 4 for every year at once
+    frame['runningpop'] = frame.groupby('bin_year')['pop'].cumsum()
+    frame['quintile'] = frame.groupby('bin_year')['runningpop'].transform(lambda r: pd.cut(r, bins=bins, labels=False))
+    return frame.groupby(['quintile', 'bin_year'])['RRinc'].mean().unstack('bin_year').astype(np.float64)
+
+
+def pair_curves(table, years, pairs=None):
+    # The growth of every bucket between every pair of years, the earlier year first
+    if pairs is None:
+        pairs = list(combinations(years, 2))
+    curves = pd.DataFrame({pair: (table[pair[1]] - table[pair[0]])/table[pair[0]] for pair in pairs})
+    return label_pairs(curves, pairs)
+
+
+def label_pairs(curves, pairs):
+    # from_arrays, unlike from_tuples, also works with no pairs at all
+    curves.columns = pd.MultiIndex.from_arrays([[a for a, b in pairs], [b for a, b in pairs]], names=['from', 'to'])
+    return curves
+
+
+def elephant_curves(years=(1988, 1993, 1998, 2003, 2008), mysample=1, bins=20, index=None):
+    if index is None:
+        index = YearIndex(lmwpid)
+    if not np.isscalar(bins):
+        return {b: elephant_curves(years, mysample, b, index) for b in bins}
+
+    table = quantile_tables(index, list(years), mysample, bins)
+    return pair_curves(table, years)
+
+
+# In[ ]:
+
+
+curves = elephant_curves(index=index)
+curves
+
+
+# In[ ]:
+
+
+'''Each year's table should match Steps 1 to 4 for that year'''
+years = [1988, 1993, 1998, 2003, 2008]
+for mysample in [0, 1]:
+    for bins in [10, 20, 50]:
+        table = quantile_tables(index, years, mysample, bins)
+        for year in years:
+            assert(np.allclose(table[year].dropna(), quantile_means(small, year, mysample, bins), rtol=1e-6))
+
+'''and every pair of years should give the same curve as working it out by hand'''
+assert(len(curves.columns) == 10)
+for a, b in combinations(years, 2):
+    by_hand = (quantile_means(small, b) - quantile_means(small, a))/quantile_means(small, a)
+    assert(np.allclose(curves[(a, b)], by_hand, rtol=1e-6))
+
+several = elephant_curves(mysample=0, bins=[10, 20], index=index)
+assert(list(several) == [10, 20] and several[20].shape == (20, 10))
+assert(np.allclose(several[10][(1988, 2008)], elephant_curves([1988, 2008], 0, 10, index)[(1988, 2008)]))
+
+
+# Working out all ten pairs by repeating Steps 1 to 6 for every pair, compared to `elephant_curves`:
+
+# In[ ]:
+
+
+start = time.perf_counter()
+for a, b in combinations(years, 2):
+    (quantile_means(lmwpid, b) - quantile_means(lmwpid, a))/quantile_means(lmwpid, a)
+print('pair by pair:    %.1f ms' % ((time.perf_counter() - start)*1000))
+
+start = time.perf_counter()
+elephant_curves(index=index)
+print('elephant_curves: %.1f ms' % ((time.perf_counter() - start)*1000))
+
+curves.plot(figsize=(10, 6))
+
+
+# ## Step 11: Exact Population Buckets
+# 
+# As the note in Step 3 says, `pd.cut` does not really split the population into equal parts. It cuts the range of `runningpop` into equal widths and puts each whole record into the bucket its running total ends in, so a record holding a large population, like a decile of rural China, can push a bucket well past 5% of the population. Step 4 then takes a plain mean of the RRinc values in each bucket, so a decile of a small country counts as much as a decile of a large one.
+# 
+# `weighted_quantile_means` does both parts exactly. Think of the records, sorted by RRinc, as lying next to each other along the population axis, each one as wide as its population. The bucket edges are at exact multiples of the total population divided by the number of buckets, and `np.searchsorted` on the running population finds the record each edge falls in. `bucket_pieces` splits each of those records at the edge into two pieces, with its population divided in proportion, so every bucket holds exactly the same population, and gives back the record, the bucket and the population of every piece. Each bucket's population weighted mean RRinc is then the sum of population times RRinc over its pieces divided by its population, and `np.bincount` with weights adds up all of the buckets in one call. Apart from the sort, which the `YearIndex` has already done, this takes time proportional to the number of records plus the number of buckets, so it works just as well with thousands of buckets.
+# 
+# `exact_tables` makes the same kind of table as `quantile_tables` with these exact buckets, and `elephant_curves` now takes `method='exact'` to use it. The default `method='cut'` keeps the `pd.cut` buckets of Steps 3 and 4.
+
+# In[ ]:
+
+
+def bucket_pieces(pop, bins=20):
+    # pop holds the population of each record, in RRinc order
+    runningpop = np.cumsum(pop, dtype=np.float64)
+
+    # Each inner bucket edge falls inside record `inside` and splits it in two pieces
+    edges = runningpop[-1]*np.arange(1, bins)/bins
+    inside = np.searchsorted(runningpop, edges)
+    ends = np.insert(runningpop, inside, edges)
+    record = np.insert(np.arange(len(runningpop)), inside, inside)
+    width = np.diff(ends, prepend=0.0)
+
+    # Bucket k+1 starts with the piece right after edge k
+    bucket = np.zeros(len(width), dtype=np.int64)
+    bucket[inside + np.arange(1, bins)] = 1
+    return record, np.cumsum(bucket), width
+
+
+def weighted_quantile_means(income, pop, bins=20):
+    # income must be sorted, and pop holds the population of each record
+    income = np.asarray(income, dtype=np.float64)
+    record, bucket, width = bucket_pieces(pop, bins)
+    return np.bincount(bucket, width*income[record], bins)/np.bincount(bucket, width, bins)
+
+
+def exact_tables(index, years, mysample=1, bins=20):
+    table = pd.DataFrame({year: weighted_quantile_means(index.get(year, mysample, 'RRinc'), index.get(year, mysample, 'pop'), bins)
+                          for year in years})
+    table.index.name = 'quintile'
+    table.columns.name = 'bin_year'
+    return table
+
+
+def elephant_curves(years=(1988, 1993, 1998, 2003, 2008), mysample=1, bins=20, index=None, method='cut'):
+    if index is None:
+        index = YearIndex(lmwpid)
+    if not np.isscalar(bins):
+        return {b: elephant_curves(years, mysample, b, index, method) for b in bins}
+
+    if method == 'cut':
+        table = quantile_tables(index, list(years), mysample, bins)
+    elif method == 'exact':
+        table = exact_tables(index, list(years), mysample, bins)
+    else:
+        raise ValueError("unknown method %r, expected 'cut' or 'exact'" % method)
+    return pair_curves(table, years)
+
+
+# In[ ]:
+
+
+'''Records of equal population are split evenly between buckets'''
+income = np.arange(1., 11.)
+assert(np.allclose(weighted_quantile_means(income, np.ones(10), 10), income))
+assert(np.allclose(weighted_quantile_means(income, np.ones(10), 5), [1.5, 3.5, 5.5, 7.5, 9.5]))
+assert(np.allclose(weighted_quantile_means(income, np.ones(10), 20), np.repeat(income, 2)))
+'''A bucket that cuts a record in half gets half of its population'''
+assert(np.allclose(weighted_quantile_means([1., 2., 3.], [1., 1., 2.], 2), [1.5, 3]))
+assert(np.allclose(weighted_quantile_means([1., 2., 3.], [1., 2., 1.], 2), [1.5, 2.5]))
+
+'''Each bucket's total income should match the area under the running income curve between its edges'''
+for mysample in [0, 1]:
+    for year in years:
+        rrinc, pop = index.get(year, mysample, 'RRinc').astype(float), index.get(year, mysample, 'pop').astype(float)
+        for bins in [20, 100, 3000]:
+            means = weighted_quantile_means(rrinc, pop, bins)
+            edges = np.linspace(0, pop.sum(), bins + 1)
+            running = np.interp(edges, np.r_[0, np.cumsum(pop)], np.r_[0, np.cumsum(pop*rrinc)])
+            assert(np.allclose(means, np.diff(running)/np.diff(edges)))
+            assert(np.all(np.diff(means) >= -1e-9*means.max()))
+            assert(np.isclose(means.mean(), np.average(rrinc, weights=pop)))
+
+'''The exact curves come from the exact tables in the same way'''
+exact = elephant_curves(index=index, method='exact')
+table = exact_tables(index, [1988, 2008])
+assert(exact.shape == curves.shape and np.allclose(exact[(1988, 2008)], (table[2008] - table[1988])/table[1988]))
+
+
+# The exact buckets for 1988 to 2008 compared to the `pd.cut` buckets, and how long the exact engine takes for a million records and a thousand buckets:
+
+# In[ ]:
+
+
+pd.DataFrame({'pd.cut': curves[(1988, 2008)], 'exact': exact[(1988, 2008)]}).plot()
+
+rng = np.random.default_rng(0)
+income = np.sort(rng.lognormal(8, 1.5, 10**6))
+pop = rng.random(10**6)
+start = time.perf_counter()
+weighted_quantile_means(income, pop, 1000)
+print('1,000,000 records, 1000 buckets: %.1f ms' % ((time.perf_counter() - start)*1000))
+
+
+# ## Step 12: Streaming Records Through a Quantile Sketch
+# 
+# Everything so far loads a whole year into memory and sorts it. That is fine for 750 country deciles, but the same curves can be made from household survey data with hundreds of millions of weighted records, which would not fit in memory, let alone be sorted.
+# 
+# An `IncomeSketch` summarizes any number of records in a fixed amount of memory, reading them a chunk at a time. It splits the income axis into cells whose edges grow by a factor of `1 + accuracy` from one cell to the next, starting at `low` and ending at `high` (like the DDSketch quantile sketch), and keeps only two numbers per cell: the total population of the records that fell into it, and the total of population times RRinc. Adding a chunk is just two `np.bincount` calls, two sketches can be merged by adding their arrays, and the memory used depends only on `accuracy`, `low` and `high`, never on the number of records. With the default `accuracy=1e-3` from 0.01 to a billion that is about 25,000 cells.
+# 
+# `IncomeSketch.table` treats every cell as one record, whose RRinc is the population weighted mean RRinc of the cell, and hands them to `weighted_quantile_means` from Step 11. The cells are already in income order, so no sort is needed.
+# 
+# **Error bound.** The sketch keeps the exact population and income of every cell, and it keeps the cells in order, so it only loses the order of records within a cell. For every point of the population, the true RRinc at that point and the one the sketch uses therefore lie in the same cell, and differ by at most a factor of `1 + accuracy` (up to rounding). Each bucket mean is an average over such points, so every bucket mean from the sketch is within a relative error of `accuracy` of the exact bucket mean from Step 11, whatever the number of buckets. A growth ratio between two years is then off by at most about `2*accuracy` times one plus the growth. The bound only holds for incomes between `low` and `high`: records outside that range are kept in one extra cell at each end, and are counted in `outside`.
+# 
+# `stream_tables` reads a CSV file once in chunks with `pd.read_csv(chunksize=...)`, reading only the four columns it needs, and feeds the records of each year into a sketch of its own. `stream_curves` turns those tables into growth curves for every pair of years, like `elephant_curves`. A year with no rows in the file raises a `KeyError`, and asking an empty sketch for its table a `ValueError`.
+
+# In[ ]:
+
+
+class IncomeSketch:
+    def __init__(self, accuracy=1e-3, low=1e-2, high=1e9):
+        self.accuracy = accuracy
+        self.low = low
+        self.high = high
+        # Cell 0 holds incomes below low, and the last cell incomes of high and above
+        self.cells = int(np.ceil(np.log(high/low)/np.log1p(accuracy))) + 2
+        self.pop = np.zeros(self.cells)
+        self.income = np.zeros(self.cells)
+        self.records = 0
+        self.outside = 0
+
+    def cell(self, income):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            c = np.floor(np.log(np.asarray(income, dtype=np.float64)/self.low)/np.log1p(self.accuracy)) + 1
+        return np.clip(np.nan_to_num(c, nan=0.0, neginf=0.0), 0, self.cells - 1).astype(np.int64)
+
+    def add(self, income, pop):
+        income = np.asarray(income, dtype=np.float64)
+        pop = np.asarray(pop, dtype=np.float64)
+        c = self.cell(income)
+        self.pop += np.bincount(c, weights=pop, minlength=self.cells)
+        self.income += np.bincount(c, weights=pop*income, minlength=self.cells)
+        self.records += len(income)
+        self.outside += int(np.count_nonzero((c == 0) | (c == self.cells - 1)))
+
+    def merge(self, other):
+        if (other.accuracy, other.low, other.high) != (self.accuracy, self.low, self.high):
+            raise ValueError('only sketches with the same accuracy, low and high can be merged')
+        self.pop += other.pop
+        self.income += other.income
+        self.records += other.records
+        self.outside += other.outside
+
+    def table(self, bins=20):
+        used = self.pop > 0
+        if not used.any():
+            raise ValueError('the sketch holds no population yet')
+        return weighted_quantile_means(self.income[used]/self.pop[used], self.pop[used], bins)
+
+
+def stream_tables(path, years, mysample=1, bins=20, accuracy=1e-3, chunksize=1 << 20):
+    sketches = {year: IncomeSketch(accuracy) for year in years}
+    for chunk in pd.read_csv(path, usecols=['bin_year', 'mysample', 'pop', 'RRinc'], chunksize=chunksize):
+        chunk = chunk[chunk['mysample'] == mysample]
+        for year, rows in chunk.groupby('bin_year'):
+            if year in sketches:
+                sketches[year].add(rows['RRinc'].values, rows['pop'].values)
+    for year in years:
+        if sketches[year].records == 0:
+            raise KeyError('no rows for bin_year %r and mysample %r' % (year, mysample))
+    table = pd.DataFrame({year: sketches[year].table(bins) for year in years})
+    table.index.name = 'quintile'
+    table.columns.name = 'bin_year'
+    return table, sketches
+
+
+def stream_curves(path, years=(1988, 1993, 1998, 2003, 2008), mysample=1, bins=20, accuracy=1e-3, chunksize=1 << 20):
+    table, sketches = stream_tables(path, list(years), mysample, bins, accuracy, chunksize)
+    return pair_curves(table, years)
+
+
+# In[ ]:
+
+
+'''Every bucket mean from the sketch should be within the error bound of the exact one'''
+rng = np.random.default_rng(20)
+income = rng.lognormal(8, 1.5, 200000)
+pop = rng.random(200000)
+order = np.argsort(income)
+sketch = IncomeSketch()
+for k in range(0, len(income), 30000):
+    sketch.add(income[k:k+30000], pop[k:k+30000])
+for bins in [20, 100, 2000]:
+    exact_means = weighted_quantile_means(income[order], pop[order], bins)
+    assert(np.all(np.abs(sketch.table(bins)/exact_means - 1) <= sketch.accuracy*(1 + 1e-9)))
+assert(sketch.records == 200000 and sketch.outside == 0 and len(sketch.pop) == sketch.cells < 26000)
+'''An empty sketch has no buckets to give'''
+try:
+    IncomeSketch().table()
+    assert(False)
+except ValueError as error:
+    assert('no population' in str(error))
+
+'''Sketches of two halves merge into the sketch of the whole'''
+first, second = IncomeSketch(), IncomeSketch()
+first.add(income[:100000], pop[:100000])
+second.add(income[100000:], pop[100000:])
+first.merge(second)
+assert(np.allclose(first.pop, sketch.pop) and np.allclose(first.income, sketch.income))
+
+'''Streaming the CSV file in small chunks should give the exact curves, within the bound'''
+streamed = stream_curves('LMWPIDweb.csv', chunksize=500)
+exact = elephant_curves(index=YearIndex(lmwpid), method='exact')
+assert(np.all(np.abs(streamed - exact) <= 2.01e-3*(1 + exact)))
+
+
+# Streaming a million records from a file, 100,000 at a time:
+
+# In[ ]:
+
+
+folder = tempfile.mkdtemp()
+big = os.path.join(folder, 'big.csv')
+rng = np.random.default_rng(0)
+n = 10**6
+pd.DataFrame({'bin_year': rng.choice([1988, 2008], n), 'mysample': 1,
+              'pop': rng.random(n), 'RRinc': rng.lognormal(8, 1.5, n).round()}).to_csv(big, index=False)
+
+start = time.perf_counter()
+big_curves = stream_curves(big, years=[1988, 2008], bins=100, chunksize=100000)
+print('%.2f s' % (time.perf_counter() - start))
+shutil.rmtree(folder)
+
+
+# ## Step 13: Bootstrap Confidence Bands
+# 
+# The elephant curve is an estimate made from one sample of survey data, and it should be published with an idea of how much it could change with a different sample. The bootstrap gives us that: draw many new samples from the data we have, work out the curve for each of them, and see how far the curves spread.
+# 
+# Each bootstrap replicate of a year draws as many records as the year has, with replacement, choosing each record with a chance proportional to its population, and gives every draw the same share of the total population. Since the records of a year are already sorted by RRinc in the `YearIndex`, a replicate does not need to be sorted again: it is enough to know how many times each record was drawn. `rng.multinomial` draws those counts for many replicates at once, as one row per replicate.
+# 
+# `replicate_tables` then works out the exact bucket means of Step 11 for all of the rows at once. Along each row the running count of draws and the running total of draws times RRinc give the running income at the end of every record, and the running income at each bucket edge is found by interpolating inside the record the edge falls in. To find those records for all rows with one `np.searchsorted` call, the running counts of all of the rows are laid end to end, each row shifted past the end of the one before it.
+# 
+# `bootstrap_bands` splits the replicates of both years into `tasks` pieces and works them out in a pool of worker processes. Every piece gets its own random seed, spawned from `seed` with `np.random.SeedSequence`, so the bands come out the same however many workers run and in whatever order they finish. It returns the exact elephant curve of Step 11 together with the `levels` percentiles of the replicate curves for every bucket. Like `batch_layout` in the GraphLayout notebook, the worker processes need to see the functions defined in this notebook, so the pool starts them by forking this process, which works on Linux and macOS but not on Windows.
+
+# In[ ]:
+
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+def replicate_tables(income, counts, bins=20):
+    # counts[r,i] is how many times replicate r drew record i, and income is sorted
+    # Every replicate draws as many records as there are
+    replicates, n = counts.shape
+    draws = n
+    running = np.cumsum(counts, axis=1)
+    running_income = np.cumsum(counts*income, axis=1)
+
+    # Find the record each bucket edge falls in, for all rows with one searchsorted
+    edges = draws*np.arange(bins + 1)/bins
+    shift = (draws + 1)*np.arange(replicates)
+    inside = np.searchsorted((running + shift[:,None]).ravel(), (edges + shift[:,None]).ravel())
+    inside = inside.reshape(replicates, bins + 1) - n*np.arange(replicates)[:,None]
+    inside = np.minimum(inside, n - 1)
+
+    # Running income at each edge: everything before the record, plus the part of the record up to the edge
+    row = np.arange(replicates)[:,None]
+    before = np.where(inside > 0, running[row, inside - 1], 0)
+    income_before = np.where(inside > 0, running_income[row, inside - 1], 0.0)
+    at_edge = income_before + (edges - before)*income[inside]
+    return np.diff(at_edge, axis=1)/(draws/bins)
+
+
+def bootstrap_tables(income, pop, bins, replicates, seed):
+    # Runs in a worker process
+    rng = np.random.default_rng(seed)
+    income = np.asarray(income, dtype=np.float64)
+    pop = np.asarray(pop, dtype=np.float64)
+    counts = rng.multinomial(len(pop), pop/pop.sum(), size=replicates)
+    return replicate_tables(income, counts, bins)
+
+
+def bootstrap_bands(start=1988, end=2008, mysample=1, bins=20, replicates=1000, levels=(2.5, 97.5),
+                    seed=0, index=None, tasks=8, parallel=True, max_workers=None):
+    if index is None:
+        index = YearIndex(lmwpid)
+    if replicates < 1:
+        raise ValueError('need at least one replicate, got %r' % replicates)
+    tasks = min(tasks, replicates)
+    sizes = np.diff(np.linspace(0, replicates, tasks + 1).astype(int))
+    seeds = np.random.SeedSequence(seed).spawn(2*tasks)
+    jobs = []
+    for k, year in enumerate([start, end]):
+        income, pop = index.get(year, mysample, 'RRinc'), index.get(year, mysample, 'pop')
+        jobs += [(income, pop, bins, size, s) for size, s in zip(sizes, seeds[k*tasks:(k+1)*tasks])]
+
+    if parallel:
+        with ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('fork')) as pool:
+            tables = list(pool.map(bootstrap_tables, *zip(*jobs)))
+    else:
+        tables = [bootstrap_tables(*job) for job in jobs]
+    before = np.concatenate(tables[:tasks])
+    after = np.concatenate(tables[tasks:])
+
+    growth = (after - before)/before
+    table = exact_tables(index, [start, end], mysample, bins)
+    bands = pd.DataFrame({'elephant': (table[end] - table[start])/table[start]})
+    for level in levels:
+        bands['%g%%' % level] = np.percentile(growth, level, axis=0)
+    return bands
+
+
+# In[ ]:
+
+
+'''Each row of replicate_tables should match the exact engine with the drawn populations'''
+rrinc, pop = index.get(1988, 1, 'RRinc').astype(float), index.get(1988, 1, 'pop').astype(float)
+counts = np.random.default_rng(1).multinomial(len(pop), pop/pop.sum(), size=5)
+tables = replicate_tables(rrinc, counts, 20)
+for r in range(5):
+    assert(np.allclose(tables[r], weighted_quantile_means(rrinc, counts[r], 20)))
+'''and drawing every record once should treat all of the records as equally large'''
+assert(np.allclose(replicate_tables(rrinc, np.ones((1, len(rrinc)), dtype=int), 100)[0],
+                   weighted_quantile_means(rrinc, np.ones(len(rrinc)), 100)))
+
+'''The bands should not depend on the number of worker processes'''
+bands = bootstrap_bands(replicates=400, seed=7, index=index)
+assert(np.allclose(bands, bootstrap_bands(replicates=400, seed=7, index=index, parallel=False)))
+assert(np.allclose(bands, bootstrap_bands(replicates=400, seed=7, index=index, max_workers=1)))
+assert(not np.allclose(bands, bootstrap_bands(replicates=400, seed=8, index=index, parallel=False)))
+'''Fewer replicates than tasks should still work'''
+assert(bootstrap_bands(replicates=4, index=index, parallel=False).shape == (20, 3))
+'''and should hold the estimate for almost every bucket'''
+assert(np.allclose(bands['elephant'], exact[(1988, 2008)]))
+assert(((bands['2.5%'] <= bands['elephant']) & (bands['elephant'] <= bands['97.5%'])).mean() >= 0.9)
+
+
+# The exact elephant curve with its 95% bootstrap band from 2000 replicates:
+
+# In[ ]:
+
+
+start = time.perf_counter()
+bands = bootstrap_bands(replicates=2000, index=index)
+print('%.2f s' % (time.perf_counter() - start))
+
+ax = bands['elephant'].plot()
+ax.fill_between(bands.index, bands['2.5%'], bands['97.5%'], alpha=0.3)
+
+
+# ## Step 14: Remembering Bucket Tables
+# 
+# When the curves are shown on a dashboard, people keep going back to the same few pairs of years and numbers of buckets, and each time the bucket means of both years are worked out again from the data. The bucket means of one year only depend on the data, the year, `mysample`, the number of buckets and the way of making buckets (`'cut'` or `'exact'`), so they can be worked out once and remembered.
+# 
+# A `TableCache` keeps the bucket means of up to `maxsize` years, like the `FactorCache` of the GraphLayout notebook. It is keyed by all five of those things, with the data stood for by `YearIndex.fingerprint()`, a blake2b hash of the sorted columns of the index that it works out the first time it is asked for and keeps. The year, `mysample` and number of buckets are turned into plain Python integers first, so `np.int64(1988)` and `1988` are the same key. When the cache is full, the table that was used longest ago is dropped (least recently used). Given a `folder`, every table is also saved there as a small `.npz` file named after its key, so a new session, or another process, can load it from disk instead of working it out again. Each file is written under a temporary name in the same folder and then renamed with `os.replace`, so a process never sees half a file. `hits` counts the tables found in memory, `loads` the ones read back from disk, and `misses` the ones that had to be worked out.
+# 
+# `cached_curves` gives the same curves as `elephant_curves`, but takes each year's table from the cache, so a repeated request is a few lookups and one division.
+
+# In[ ]:
+
+
+import tempfile
+from collections import OrderedDict
+
+class TableCache:
+    def __init__(self, maxsize=64, folder=None):
+        self.maxsize = maxsize
+        self.folder = folder
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.loads = 0
+        self.misses = 0
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def path(self, key):
+        name = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.folder, name + '.npz')
+
+    def save(self, key, means):
+        # Written to a file of its own first, so another process never loads half a table
+        handle, temporary = tempfile.mkstemp(dir=self.folder, suffix='.npz')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, quintile=means.index.values, RRinc=means.values)
+            os.replace(temporary, self.path(key))
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    def get(self, key):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.folder is not None and os.path.exists(self.path(key)):
+            with np.load(self.path(key)) as saved:
+                means = pd.Series(saved['RRinc'], index=pd.Index(saved['quintile'], name='quintile'), name='RRinc')
+            self.loads += 1
+            self.put(key, means, save=False)
+            return means
+        self.misses += 1
+        return None
+
+    def put(self, key, means, save=True):
+        self.entries[key] = means
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        if save and self.folder is not None:
+            self.save(key, means)
+
+    def means(self, index, year, mysample=1, bins=20, weighting='cut'):
+        # NumPy integers would give a different repr, and so a different file, than Python ones
+        key = (index.fingerprint(), int(year), int(mysample), int(bins), str(weighting))
+        means = self.get(key)
+        if means is None:
+            if weighting == 'cut':
+                means = index.quantile_means(year, mysample, bins)
+            elif weighting == 'exact':
+                means = weighted_quantile_means(index.get(year, mysample, 'RRinc'), index.get(year, mysample, 'pop'), bins)
+                means = pd.Series(means, index=pd.Index(np.arange(bins), name='quintile'), name='RRinc')
+            else:
+                raise ValueError("unknown weighting %r, expected 'cut' or 'exact'" % weighting)
+            self.put(key, means)
+        return means
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.loads = 0
+        self.misses = 0
+
+
+table_cache = TableCache()
+
+def cached_curves(years=(1988, 1993, 1998, 2003, 2008), mysample=1, bins=20, index=None, method='cut', cache=None):
+    if index is None:
+        index = YearIndex(lmwpid)
+    if cache is None:
+        cache = table_cache
+
+    table = pd.DataFrame({year: cache.means(index, year, mysample, bins, method) for year in years})
+    return pair_curves(table, years)
+
+
+# In[ ]:
+
+
+'''Cached curves should be the same as elephant_curves, for both ways of making buckets'''
+cache = TableCache(maxsize=8)
+for method in ['cut', 'exact']:
+    assert(np.allclose(cached_curves(index=index, method=method, cache=cache), elephant_curves(index=index, method=method)))
+assert((cache.hits, cache.loads, cache.misses) == (0, 0, 10) and len(cache) == 8)
+
+'''Asking again should only hit the cache, and the oldest tables should have been dropped'''
+cached_curves([2003, 2008], index=index, method='exact', cache=cache)
+assert((cache.hits, cache.misses) == (2, 10))
+cached_curves([1988], index=index, method='cut', cache=cache)
+assert((cache.hits, cache.misses) == (2, 11))
+'''A different dataset, mysample or number of buckets is a different key'''
+cache.means(YearIndex(lmwpid), 1988, 1, 20, 'exact')
+cache.means(index, 1988, 0, 20, 'exact')
+cache.means(index, 1988, 1, 10, 'exact')
+assert((cache.hits, cache.misses) == (2, 14))
+assert(YearIndex(small).fingerprint() == index.fingerprint() != YearIndex(lmwpid).fingerprint())
+'''NumPy and Python integers are the same key'''
+cache.means(index, np.int64(1988), np.int64(1), np.int64(10), 'exact')
+assert((cache.hits, cache.misses) == (3, 14))
+
+'''Tables saved in a folder should be loaded by a new cache'''
+folder = tempfile.mkdtemp()
+first = cached_curves(index=index, bins=50, cache=TableCache(folder=folder))
+second_cache = TableCache(folder=folder)
+assert(np.array_equal(cached_curves(index=index, bins=50, cache=second_cache), first))
+assert((second_cache.hits, second_cache.loads, second_cache.misses) == (0, 5, 0))
+third_cache = TableCache(folder=folder)
+third_cache.means(index, np.int64(1988), bins=np.int64(50))
+assert((third_cache.loads, third_cache.misses) == (1, 0))
+'''and no temporary files are left behind'''
+assert(all(name.endswith('.npz') for name in os.listdir(folder)) and len(os.listdir(folder)) == 5)
+shutil.rmtree(folder)
+
+
+# Working out the curves for the same pair of years again and again, with and without the cache:
+
+# In[ ]:
+
+
+start = time.perf_counter()
+for k in range(100):
+    elephant_curves([1988, 2008], index=index)
+print('elephant_curves: %.2f ms' % ((time.perf_counter() - start)*10))
+
+start = time.perf_counter()
+for k in range(100):
+    cached_curves([1988, 2008], index=index)
+print('cached_curves:   %.2f ms' % ((time.perf_counter() - start)*10))
+
+
+# ## Step 15: Adding a New Year Without Starting Over
+# 
+# The LM-WPID panel grows one `bin_year` at a time, and we add later years of our own to it. So far every change means reading the whole file again and working out the tables and curves of every year, even though only one year is new.
+# 
+# A `PanelCurves` keeps the data split into partitions, one for each (`bin_year`, `mysample`) pair, and for every partition a content hash (`partition_hash`, a blake2b hash of its population and RRinc values sorted by RRinc and then population, so the order the rows come in does not matter), its bucket table, and the curves between it and every other year with the same `mysample`. There are two ways to give it new data:
+# 
+# * `update(table)` takes the whole panel, for example after reading the file again. It hashes every partition, and works out the tables only of the partitions whose hash is new or has changed. Partitions that are no longer in the panel are dropped.
+# * `append(rows)` takes only the new rows. The rows of each partition are added to the ones it already holds, and only the partitions that got new rows are hashed and worked out again, so adding a year costs time in proportion to the rows of that year, not the whole panel.
+# 
+# In both cases only the curves between a changed year and the other years are worked out again, by giving `pair_curves` just those pairs, and both give back the list of partitions that changed. `curves(mysample)` puts the stored curves together in the same layout as `elephant_curves`, with no columns while a `mysample` has only one year.
+
+# In[ ]:
+
+
+def partition_hash(pop, rrinc):
+    # Records with the same RRinc can come in any order, so hash them sorted by RRinc and then pop
+    pop = np.asarray(pop, dtype=np.float64)
+    rrinc = np.asarray(rrinc, dtype=np.float64)
+    order = np.lexsort((pop, rrinc))
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.ascontiguousarray(pop[order]).tobytes())
+    h.update(np.ascontiguousarray(rrinc[order]).tobytes())
+    return h.hexdigest()
+
+
+def split_partitions(table):
+    # A YearIndex of its own for each (bin_year, mysample) pair
+    whole = YearIndex(table)
+    parts = {}
+    for (year, sample), (a, b) in whole.offsets.items():
+        parts[(year, sample)] = YearIndex({'bin_year': np.full(b - a, year), 'mysample': np.full(b - a, sample),
+                                           'pop': whole.columns['pop'][a:b], 'RRinc': whole.columns['RRinc'][a:b]})
+    return parts
+
+
+class PanelCurves:
+    def __init__(self, bins=20, method='cut'):
+        if method not in ('cut', 'exact'):
+            raise ValueError("unknown method %r, expected 'cut' or 'exact'" % method)
+        self.bins = bins
+        self.method = method
+        self.parts = {}
+        self.hashes = {}
+        self.tables = {}
+        self.pairs = {}
+        self.computed = 0
+
+    def table(self, part, year, mysample):
+        if self.method == 'cut':
+            return part.quantile_means(year, mysample, self.bins)
+        means = weighted_quantile_means(part.get(year, mysample, 'RRinc'), part.get(year, mysample, 'pop'), self.bins)
+        return pd.Series(means, index=pd.Index(np.arange(self.bins), name='quintile'), name='RRinc')
+
+    def refresh(self, parts):
+        changed = []
+        for (year, sample), part in sorted(parts.items()):
+            h = partition_hash(part.get(year, sample, 'pop'), part.get(year, sample, 'RRinc'))
+            if self.hashes.get((year, sample)) != h:
+                self.parts[(year, sample)] = part
+                self.hashes[(year, sample)] = h
+                self.tables[(year, sample)] = self.table(part, year, sample)
+                self.computed += 1
+                changed.append((year, sample))
+
+        # Only the curves between a changed year and the others need working out again
+        for sample in sorted(set(s for year, s in changed)):
+            years = sorted(year for year, s in self.tables if s == sample)
+            fresh = [(a, b) for a, b in combinations(years, 2) if (a, sample) in changed or (b, sample) in changed]
+            table = pd.DataFrame({year: self.tables[(year, sample)] for year in years})
+            curves = pair_curves(table, years, fresh)
+            for pair in fresh:
+                self.pairs[(sample,) + pair] = curves[pair]
+        return changed
+
+    def drop(self, year, mysample):
+        for store in (self.parts, self.hashes, self.tables):
+            del store[(year, mysample)]
+        for key in [key for key in self.pairs if key[0] == mysample and year in key[1:]]:
+            del self.pairs[key]
+
+    def update(self, table):
+        parts = split_partitions(table)
+        for key in [key for key in self.parts if key not in parts]:
+            self.drop(*key)
+        return self.refresh(parts)
+
+    def append(self, rows):
+        parts = split_partitions(rows)
+        for (year, sample), part in parts.items():
+            if (year, sample) in self.parts:
+                old = self.parts[(year, sample)]
+                pop = np.concatenate([old.get(year, sample, 'pop'), part.get(year, sample, 'pop')])
+                rrinc = np.concatenate([old.get(year, sample, 'RRinc'), part.get(year, sample, 'RRinc')])
+                parts[(year, sample)] = YearIndex({'bin_year': np.full(len(pop), year), 'mysample': np.full(len(pop), sample),
+                                                   'pop': pop, 'RRinc': rrinc})
+        return self.refresh(parts)
+
+    def curves(self, mysample=1):
+        pairs = sorted((a, b) for s, a, b in self.pairs if s == mysample)
+        return label_pairs(pd.DataFrame({pair: self.pairs[(mysample,) + pair] for pair in pairs}), pairs)
+
+
+# In[ ]:
+
+
+'''Appending the last year should only work out its two partitions, and give the same curves as starting over'''
+for method in ['cut', 'exact']:
+    panel = PanelCurves(method=method)
+    assert(len(panel.update(lmwpid[lmwpid['bin_year'] < 2008])) == 8 and panel.computed == 8)
+    assert(panel.append(lmwpid[lmwpid['bin_year'] == 2008]) == [(2008, 0), (2008, 1)] and panel.computed == 10)
+    for mysample in [0, 1]:
+        assert(np.allclose(panel.curves(mysample), elephant_curves(mysample=mysample, index=YearIndex(lmwpid), method=method)))
+
+'''Reading the same panel again changes nothing, even with the rows in another order'''
+assert(panel.update(lmwpid) == [] and panel.computed == 10)
+assert(panel.update(lmwpid.sample(frac=1, random_state=23)) == [] and panel.computed == 10)
+
+'''Changing one record should only work out its partition and the curves with it again'''
+changed = lmwpid.copy()
+changed.loc[(changed['bin_year'] == 1993) & (changed['mysample'] == 1), 'RRinc'] += 100
+before = panel.curves(1).copy()
+assert(panel.update(changed) == [(1993, 1)] and panel.computed == 11)
+assert(np.allclose(panel.curves(1), elephant_curves(index=YearIndex(changed), method='exact')))
+assert(np.array_equal(panel.curves(1)[(2003, 2008)], before[(2003, 2008)]))
+assert(not np.allclose(panel.curves(1)[(1988, 1993)], before[(1988, 1993)]))
+
+'''Rows of a year can come in two pieces, and years that go away are dropped'''
+panel = PanelCurves(method='exact')
+rows = lmwpid[lmwpid['bin_year'] == 1998]
+panel.update(lmwpid[lmwpid['bin_year'] != 1998])
+panel.append(rows.iloc[::2])
+panel.append(rows.iloc[1::2])
+assert(np.allclose(panel.curves(1), elephant_curves(index=YearIndex(lmwpid), method='exact')))
+panel.update(lmwpid[lmwpid['bin_year'] != 1988])
+assert(list(panel.curves(1).columns) == list(combinations([1993, 1998, 2003, 2008], 2)))
+
+'''A panel that starts with a single year has no curves yet'''
+panel = PanelCurves()
+assert(panel.update(lmwpid[lmwpid['bin_year'] == 1988]) == [(1988, 0), (1988, 1)])
+assert(panel.curves(1).empty and list(panel.curves(1).columns.names) == ['from', 'to'])
+panel.append(lmwpid[lmwpid['bin_year'] == 1993])
+assert(np.allclose(panel.curves(1), elephant_curves([1988, 1993], index=YearIndex(lmwpid))))
+'''pair_curves can also be given just some of the pairs'''
+table = quantile_tables(index, years)
+assert(np.array_equal(pair_curves(table, years, [(1993, 2008)]), pair_curves(table, years)[[(1993, 2008)]]))
+
+
+# Working out every year again from the whole panel, compared to appending only the new year:
+
+# In[ ]:
+
+
+start = time.perf_counter()
+elephant_curves(index=YearIndex(lmwpid))
+print('whole panel: %.1f ms' % ((time.perf_counter() - start)*1000))
+
+panel = PanelCurves()
+panel.update(lmwpid[lmwpid['bin_year'] < 2008])
+start = time.perf_counter()
+panel.append(lmwpid[lmwpid['bin_year'] == 2008])
+print('append 2008: %.1f ms' % ((time.perf_counter() - start)*1000))
+
+
+# ## Step 16: Percentile Curves with NumPy Only
+# 
+# With 20 buckets every bucket is five percent of the world's population. To see the curve at the level of single percentiles, or even tenths of a percentile, we need 100 to 1000 buckets, and then the time `pd.cut` and `groupby` spend on every bucket adds up.
+# 
+# `numpy_tables` does Steps 1 to 4 for several years with NumPy alone. It picks out the rows of `mysample` and sorts them once, by `bin_year` and then by RRinc, so the rows of each year are next to each other and in order. For each year it adds up the running population, and instead of finding the bucket of every record it finds where every bucket starts: the buckets are the same equal widths of the running population that `pd.cut` uses, and since the running population only goes up, `np.searchsorted` of the bucket edges gives the first record of each bucket. The number of records in each bucket is then the difference of where it starts and where the next one starts, and `np.bincount` adds up the RRinc of each bucket in one call. Buckets with no records are left as NaN, where `groupby` would leave them out. Like `pd.cut`, it widens both ends of the range by 0.1% when a year's running population has no width, as with a single record. With `weighting='exact'` the buckets of Step 11 are used instead. All of the results go straight into one array with a row for each year, made before the first year is worked out. A year with no rows for `mysample` raises the same `KeyError` as `YearIndex.rows`.
+# 
+# `numpy_curves` turns that array into the curves of every pair of years with one division, using `np.triu_indices` to pick the pairs, and gives back the list of pairs and an array with one row per pair. With `frame=True` it gives the same DataFrame as `elephant_curves` instead.
+
+# In[ ]:
+
+
+def numpy_tables(table, years, mysample=1, bins=1000, weighting='cut'):
+    if weighting not in ('cut', 'exact'):
+        raise ValueError("unknown weighting %r, expected 'cut' or 'exact'" % weighting)
+    rows = np.flatnonzero(np.asarray(table['mysample']) == mysample)
+    year = np.asarray(table['bin_year'])[rows]
+    rrinc = np.asarray(table['RRinc'])[rows]
+    order = np.lexsort((rrinc, year))
+    year, rrinc = year[order], rrinc[order].astype(np.float64)
+    pop = np.asarray(table['pop'])[rows][order]
+
+    means = np.full((len(years), bins), np.nan)
+    starts = np.searchsorted(year, years, side='left')
+    stops = np.searchsorted(year, years, side='right')
+    for k, (a, b) in enumerate(zip(starts, stops)):
+        if a == b:
+            raise KeyError('no rows for bin_year %r and mysample %r' % (years[k], mysample))
+        if weighting == 'exact':
+            means[k] = weighted_quantile_means(rrinc[a:b], pop[a:b], bins)
+            continue
+        runningpop = np.cumsum(pop[a:b], dtype=np.float64)
+        # The same edges as pd.cut, with the lowest one moved down by 0.1% of the range,
+        # or both ends moved out by 0.1% when the range has no width
+        low, high = runningpop[0], runningpop[-1]
+        if high == low:
+            shift = 0.001*abs(low) if low != 0 else 0.001
+            edges = np.linspace(low - shift, high + shift, bins + 1)
+        else:
+            edges = np.linspace(low, high, bins + 1)
+            edges[0] -= (high - low)*0.001
+        ends = np.r_[np.searchsorted(runningpop, edges[1:-1], side='right'), b - a]
+        count = np.diff(ends, prepend=0)
+        total = np.bincount(np.repeat(np.arange(bins), count), weights=rrinc[a:b], minlength=bins)
+        full = count > 0
+        means[k, full] = total[full]/count[full]
+    return means
+
+
+def numpy_curves(table, years=(1988, 1993, 1998, 2003, 2008), mysample=1, bins=1000, weighting='cut', frame=False):
+    means = numpy_tables(table, list(years), mysample, bins, weighting)
+    a, b = np.triu_indices(len(years), 1)
+    curves = (means[b] - means[a])/means[a]
+    pairs = [(years[i], years[j]) for i, j in zip(a, b)]
+    if not frame:
+        return pairs, curves
+    return label_pairs(pd.DataFrame(curves.T, index=pd.Index(np.arange(bins), name='quintile')), pairs)
+
+
+# In[ ]:
+
+
+'''The NumPy tables should match the pd.cut tables of Step 10, with NaN for the empty buckets'''
+for mysample in [0, 1]:
+    for bins in [20, 100, 1000]:
+        means = numpy_tables(small, years, mysample, bins)
+        table = quantile_tables(index, years, mysample, bins).reindex(np.arange(bins))
+        assert(np.allclose(means, table.values.T, equal_nan=True))
+        exact_means = numpy_tables(small, years, mysample, bins, weighting='exact')
+        assert(np.allclose(exact_means, exact_tables(index, years, mysample, bins).values.T))
+
+'''The curves should match elephant_curves, as arrays or as a DataFrame'''
+pairs, arrays = numpy_curves(small, bins=100)
+assert(pairs == list(combinations(years, 2)) and arrays.shape == (10, 100))
+high = numpy_curves(small, bins=100, frame=True)
+assert(np.allclose(high, elephant_curves(bins=100, index=index).reindex(np.arange(100)), equal_nan=True))
+assert(np.allclose(numpy_curves(small, bins=1000, weighting='exact', frame=True),
+                   elephant_curves(bins=1000, index=index, method='exact')))
+'''A year with a single record lands in the same bucket as with pd.cut'''
+one = {'bin_year': [1988, 1993, 1993], 'mysample': [1, 1, 1], 'pop': [5.0, 1.0, 2.0], 'RRinc': [100.0, 50.0, 60.0]}
+for bins in [1, 4, 5]:
+    by_cut = pd.Series(pd.cut(np.cumsum(one['pop'][:1]), bins=bins, labels=False))
+    assert(np.flatnonzero(~np.isnan(numpy_tables(one, [1988], bins=bins)[0])).tolist() == by_cut.tolist())
+
+'''A year with no rows is an error, as it is for elephant_curves'''
+for weighting in ['cut', 'exact']:
+    try:
+        numpy_tables(small, [1988, 2013], weighting=weighting)
+        assert(False)
+    except KeyError as error:
+        assert('2013' in str(error))
+
+
+# Curves for every pair of years at 1000 buckets, with `pd.cut` and `groupby` (Step 10) and with NumPy alone:
+
+# In[ ]:
+
+
+start = time.perf_counter()
+elephant_curves(bins=1000, index=index)
+print('elephant_curves: %.1f ms' % ((time.perf_counter() - start)*1000))
+
+start = time.perf_counter()
+pairs, arrays = numpy_curves(small, bins=1000)
+print('numpy_curves:    %.1f ms' % ((time.perf_counter() - start)*1000))
+
+numpy_curves(small, [1988, 2008], bins=1000, weighting='exact', frame=True).plot()
+
+
+# ## Step 17: Which Countries Make Up Each Bucket
+# 
+# Step 1 keeps only `pop` and RRinc and throws away `contcod`, so the curve cannot tell us which countries, or which rural and urban halves of a country like CHN-R and CHN-U, make up each bucket, or how much of a bucket's growth each of them brings.
+# 
+# A `GrowthDecomposition` keeps `contcod` for the years `start` and `end`, and uses the exact buckets of Step 11, since those split the population of every record between buckets exactly. `bucket_pieces` from Step 11 splits the records of a year, sorted by RRinc, into the pieces that lie in each bucket, and gives back the record, the bucket and the population of every piece. A single `scipy.sparse.coo_matrix` of those pieces, with the bucket as the row and the country as the column, then adds up the population of every (bucket, country) pair at once, as converting it to CSR adds up the entries with the same row and column. A second one does the same for population times RRinc. Most countries only fall into a few buckets, so the matrices are stored sparse.
+# 
+# Since every bucket of year y holds the same population P_y, the mean RRinc of bucket k is the sum over the countries of income[k, c]/P_y. The growth of bucket k from `start` to `end` is therefore the sum over the countries of
+# 
+#     contribution[k, c] = (income_end[k, c]/P_end - income_start[k, c]/P_start)/mean_start[k]
+# 
+# which is worked out for all buckets and countries with a few sparse matrix operations, and adds up to the exact elephant curve in every bucket. `shares()` divides each row by the growth of the bucket, so each row adds up to one. `top(bucket)` lists the countries with the largest contributions to one bucket, and `frame(n)` gives the contributions of the `n` countries with the largest contributions overall, with the rest put together as `other`.
+
+# In[ ]:
+
+
+import scipy.sparse as sp
+
+class GrowthDecomposition:
+    def __init__(self, start=1988, end=2008, mysample=1, bins=20, table=None):
+        if table is None:
+            table = lmwpid
+        index = YearIndex(table, columns=('pop', 'RRinc', 'contcod'))
+        self.start, self.end, self.bins = start, end, bins
+        self.countries = pd.Index(np.unique(np.concatenate([index.get(year, mysample, 'contcod').astype(str)
+                                                            for year in [start, end]])), name='contcod')
+
+        self.pop, self.income, self.means = {}, {}, {}
+        for year in [start, end]:
+            rrinc = index.get(year, mysample, 'RRinc').astype(np.float64)
+            country = self.countries.get_indexer(index.get(year, mysample, 'contcod').astype(str))
+            record, bucket, width = bucket_pieces(index.get(year, mysample, 'pop'), bins)
+            shape = (bins, len(self.countries))
+            self.pop[year] = sp.coo_matrix((width, (bucket, country[record])), shape=shape).tocsr()
+            self.income[year] = sp.coo_matrix((width*rrinc[record], (bucket, country[record])), shape=shape).tocsr()
+            self.means[year] = np.asarray(self.income[year].sum(axis=1)).ravel()/(width.sum()/bins)
+
+        # Each bucket of a year holds the same population, so the bucket means add up over the countries
+        per_start = self.income[start]/(self.pop[start].sum()/bins)
+        per_end = self.income[end]/(self.pop[end].sum()/bins)
+        self.contribution = sp.diags(1/self.means[start]) @ (per_end - per_start)
+        self.growth = (self.means[end] - self.means[start])/self.means[start]
+
+    def shares(self):
+        return sp.diags(1/self.growth) @ self.contribution
+
+    def top(self, bucket, n=10):
+        row = self.contribution[bucket].toarray().ravel()
+        top = np.argsort(-np.abs(row), kind='stable')[:n]
+        # Share of the bucket's population in each year
+        pop = {year: self.pop[year][bucket].toarray().ravel() for year in [self.start, self.end]}
+        return pd.DataFrame({'pop %d' % self.start: pop[self.start][top]/pop[self.start].sum(),
+                             'pop %d' % self.end: pop[self.end][top]/pop[self.end].sum(),
+                             'contribution': row[top],
+                             'share': row[top]/self.growth[bucket]}, index=self.countries[top])
+
+    def frame(self, n=8):
+        top = np.argsort(-np.asarray(abs(self.contribution).sum(axis=0)).ravel(), kind='stable')[:n]
+        frame = pd.DataFrame(self.contribution[:, top].toarray(), columns=self.countries[top],
+                             index=pd.Index(np.arange(self.bins), name='quintile'))
+        frame['other'] = self.growth - frame.sum(axis=1)
+        return frame
+
+
+# In[ ]:
+
+
+'''The contributions of the countries should add up to the exact elephant curve in every bucket'''
+for bins in [20, 100]:
+    for table in [lmwpid, small]:
+        decomposition = GrowthDecomposition(bins=bins, table=table)
+        assert(np.allclose(np.asarray(decomposition.contribution.sum(axis=1)).ravel(), decomposition.growth))
+        assert(np.allclose(decomposition.growth, elephant_curves([1988, 2008], bins=bins, index=index, method='exact')[(1988, 2008)], rtol=1e-5))
+        assert(np.allclose(np.asarray(decomposition.shares().sum(axis=1)).ravel(), 1))
+
+'''Every bucket holds the same population, and every country all of its population'''
+decomposition = GrowthDecomposition(mysample=0, bins=50)
+for year in [1988, 2008]:
+    rows = lmwpid[(lmwpid['bin_year'] == year) & (lmwpid['mysample'] == 0)]
+    assert(np.allclose(np.asarray(decomposition.pop[year].sum(axis=1)).ravel(), rows['pop'].sum()/50))
+    by_country = rows.groupby('contcod')['pop'].sum().reindex(decomposition.countries, fill_value=0)
+    assert(np.allclose(np.asarray(decomposition.pop[year].sum(axis=0)).ravel(), by_country))
+    assert(np.allclose(decomposition.means[year], exact_tables(YearIndex(lmwpid), [year], 0, 50)[year]))
+'''and the matrices are stored sparse'''
+assert(decomposition.pop[1988].nnz < 0.5*np.prod(decomposition.pop[1988].shape))
+
+'''The largest contributors and the frame should add up the same way'''
+top = decomposition.top(10, n=len(decomposition.countries))
+assert(np.isclose(top['contribution'].sum(), decomposition.growth[10]) and np.isclose(top['pop 1988'].sum(), 1))
+assert(np.all(np.diff(np.abs(top['contribution'])) <= 0))
+assert(np.allclose(decomposition.frame(5).sum(axis=1), decomposition.growth))
+
+
+# The countries that bring the most of the growth to each bucket from 1988 to 2008:
+
+# In[ ]:
+
+
+decomposition = GrowthDecomposition()
+decomposition.frame(8).plot.bar(stacked=True, figsize=(12, 6))
+decomposition.top(10)
+
+
 # In[ ]:
 
 
@@ -403,6 +403,2101 @@ assert(np.round(y[4],3) == 0.636)
 graphplot(x,y,edges)
 
 
+# ## Part 5: Scaling Up the Laplacian
+# 
+# The `lap(edges)` function above fills in a dense n x n matrix one entry at a time, and for each entry it scans the whole edge list and calls `deg()`, which scans the edge list again. That is fine for six nodes, but it takes roughly n² · E steps and n² memory, so it stops being usable at a few thousand nodes.
+# 
+# Almost every entry of the Laplacian is zero, so we can build it directly from the edge list instead. Each edge [i,j] contributes exactly two off-diagonal entries, L[i,j] = -1/deg(i) and L[j,i] = -1/deg(j), and all the degrees can be counted at once with `np.bincount`. The function `lap_sparse(edges)` below does this in one vectorized pass and returns a SciPy sparse (CSR) matrix, or an ordinary dense array if `dense=True`.
+
+# In[ ]:
+
+
+import scipy.sparse as sp
+
+def lap_sparse(edges, dense=False):
+    edges = np.asarray(edges)
+    i = edges[:,0]
+    j = edges[:,1]
+
+    # Nodes are numbered from zero to the largest index found in either column
+    n = edges.max() + 1
+
+    # Every edge adds one to the degree of both of its endpoints
+    degree = np.bincount(edges.ravel(), minlength=n)
+
+    # Off-diagonal entries L[i,j] = -1/deg(i) in both directions, plus the identity diagonal
+    rows = np.concatenate([i, j, np.arange(n)])
+    cols = np.concatenate([j, i, np.arange(n)])
+    vals = np.concatenate([-1.0/degree[i], -1.0/degree[j], np.ones(n)])
+
+    L = sp.coo_matrix((vals, (rows, cols)), shape=(n, n)).tocsr()
+    if dense:
+        return L.toarray()
+    return L
+
+
+# In[ ]:
+
+
+'''The sparse Laplacian should match the one computed by lap()'''
+assert(np.allclose(lap_sparse(edges).toarray(), lap(edges)))
+assert(np.allclose(lap_sparse(edges, dense=True), lap(edges)))
+
+
+# Building the sparse Laplacian only touches each edge a constant number of times, so even a graph with a million edges takes a fraction of a second.
+
+# In[ ]:
+
+
+import time
+
+big_edges = np.random.randint(0, 200000, size=(1000000, 2))
+big_edges = big_edges[big_edges[:,0] != big_edges[:,1]]
+
+start = time.perf_counter()
+L_big = lap_sparse(big_edges)
+print(L_big.shape, L_big.nnz, '%.3f s' % (time.perf_counter() - start))
+
+
+# ## Part 6: A Graph Object
+# 
+# All of our functions so far take the raw `edges` array and work out the structure of the graph from it again on every call: `deg(i,edges)` rescans every edge each time it is asked about a single node, and `lap(edges)` counts the nodes by looking only at the second column of the edge list, so it gets the wrong answer if the largest index only appears in the first column.
+# 
+# Instead we can do that work once. The `Graph` class below takes an edge list and
+# 
+# * stores each undirected edge once as [i,j] with i < j, dropping repeated edges and self loops,
+# * fixes the number of nodes `n` from the largest index in either column (or takes it as an argument),
+# * builds a compressed sparse row (CSR) adjacency, so the neighbors of node i are `indices[indptr[i]:indptr[i+1]]`,
+# * keeps the degree of every node in the `degree` array,
+# * and computes a `fingerprint` string from the nodes and edges, so two `Graph` objects built from the same edges can be recognized as the same graph.
+# 
+# A `Graph` can also be made directly from a CSR adjacency that lists every edge in both directions with `Graph.from_csr(indptr, indices)`.
+# 
+# Everything is stored as int32 arrays, and `__slots__` keeps the object itself small.
+
+# In[ ]:
+
+
+import hashlib
+
+def edge_fingerprint(n, edges):
+    # Graphs with the same nodes and edges get the same fingerprint
+    h = hashlib.blake2b(np.int64(n).tobytes(), digest_size=16)
+    h.update(np.ascontiguousarray(edges, dtype=np.int32).tobytes())
+    return h.hexdigest()
+
+
+class Graph:
+    __slots__ = ('n', 'edges', 'indptr', 'indices', 'degree', 'fingerprint')
+
+    def __init__(self, edges, n=None):
+        edges = np.asarray(edges, dtype=np.int32).reshape(-1, 2)
+
+        # Store each undirected edge once as [min,max], without self loops or repeats
+        edges = np.sort(edges, axis=1)
+        edges = edges[edges[:,0] != edges[:,1]]
+        top = int(edges.max()) + 1 if len(edges) else 0
+        key = np.unique(edges[:,0].astype(np.int64)*top + edges[:,1])
+        edges = np.stack([key // max(top, 1), key % max(top, 1)], axis=1).astype(np.int32)
+
+        if n is None:
+            n = top
+        elif n < top:
+            raise ValueError('edge list refers to node %d but the graph has only %d nodes' % (top - 1, n))
+        self.n = n
+        self.edges = edges
+
+        # CSR adjacency built from both directions of every edge
+        src = np.concatenate([edges[:,0], edges[:,1]])
+        dst = np.concatenate([edges[:,1], edges[:,0]])
+        self.indices = dst[np.argsort(src, kind='stable')]
+        self.degree = np.bincount(src, minlength=n).astype(np.int32)
+        self.indptr = np.zeros(n + 1, dtype=np.int32)
+        np.cumsum(self.degree, out=self.indptr[1:])
+        self.fingerprint = edge_fingerprint(n, edges)
+
+    @classmethod
+    def from_csr(cls, indptr, indices, n=None):
+        # The adjacency has to list every edge in both directions. Sort each row and merge repeats.
+        if n is None:
+            n = len(indptr) - 1
+        A = sp.csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr), shape=(n, n))
+        A.sum_duplicates()
+
+        # Self loops are not edges, as in Graph(), so the diagonal is dropped
+        rows = np.repeat(np.arange(n, dtype=np.int32), np.diff(A.indptr))
+        loop = rows == A.indices
+        if loop.any():
+            A.data[loop] = 0
+            A.eliminate_zeros()
+            rows = rows[~loop]
+
+        g = cls.__new__(cls)
+        g.n = n
+        g.indptr = A.indptr.astype(np.int32, copy=False)
+        g.indices = A.indices.astype(np.int32, copy=False)
+        g.degree = np.diff(g.indptr)
+
+        # Each edge [i,j] with i < j is found in row i
+        upper = rows < g.indices
+        g.edges = np.stack([rows[upper], g.indices[upper]], axis=1)
+        g.fingerprint = edge_fingerprint(n, g.edges)
+        return g
+
+    def __repr__(self):
+        return 'Graph(n=%d, edges=%d)' % (self.n, len(self.edges))
+
+    def neighbors(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def adjacency(self):
+        return sp.csr_matrix((np.ones(len(self.indices)), self.indices, self.indptr), shape=(self.n, self.n))
+
+
+def as_graph(edges):
+    if isinstance(edges, Graph):
+        return edges
+    return Graph(edges)
+
+
+# Now `deg`, `lap` and `graphplot` can take either a `Graph` or an edge list. Given a `Graph`, `deg` is just a lookup into the degree array, and given an edge list it counts the edges at node i in one vectorized pass, since building a whole `Graph` just to look up one degree would cost more than the count itself, so code that asks for many degrees should build the `Graph` once. The Laplacian is the adjacency matrix with each row i scaled by -1/deg(i), plus the identity. We keep the Part 3 versions around as `deg_reference` and `lap_reference` to check the new ones against.
+# 
+# The `pin` function does the pinning step from Part 4: it replaces the rows of the pinned nodes with identity rows, and makes the right-hand sides b and c that hold the pinned coordinates and zeros everywhere else. Unlike the code in Part 4 it works on copies, so the Laplacian and the `x` and `y` arrays passed in are left alone.
+
+# In[ ]:
+
+
+deg_reference = deg
+lap_reference = lap
+
+def deg(i,edges):
+    if isinstance(edges, Graph):
+        return int(edges.degree[i])
+    # One pass over a plain edge list is cheaper than building a Graph for a single lookup
+    e = np.asarray(edges).reshape(-1, 2)
+    return int(np.count_nonzero((e[:,0] == i) | (e[:,1] == i)))
+
+
+def lap_sparse(edges, dense=False):
+    g = as_graph(edges)
+
+    # Row i of the Laplacian is row i of the adjacency matrix scaled by -1/deg(i)
+    vals = np.repeat(-1.0/np.maximum(g.degree, 1), g.degree)
+    L = sp.csr_matrix((vals, g.indices, g.indptr), shape=(g.n, g.n)) + sp.identity(g.n, format='csr')
+    if dense:
+        return L.toarray()
+    return L
+
+
+def lap(edges):
+    return lap_sparse(edges, dense=True)
+
+
+def pin(edges, pinned, x, y, dense=False):
+    g = as_graph(edges)
+    is_pinned = np.zeros(g.n, dtype=bool)
+    is_pinned[pinned] = True
+
+    # Drop the off-diagonal entries of the pinned rows, leaving identity rows
+    L = lap_sparse(g).tocoo()
+    keep = ~is_pinned[L.row] | (L.row == L.col)
+    L = sp.csr_matrix((L.data[keep], (L.row[keep], L.col[keep])), shape=L.shape)
+
+    # Pinned nodes keep their coordinates, every other row sums to zero
+    b = np.where(is_pinned, x, 0.0)
+    c = np.where(is_pinned, y, 0.0)
+    if dense:
+        return L.toarray(), b, c
+    return L, b, c
+
+
+def graphplot(x,y,edges):
+    edges = as_graph(edges).edges
+
+    # Display nodes as white disks with black borders with an area of 500 pts
+    plt.scatter(x,y,
+                c='white',edgecolors='black',
+                s = 500,zorder = 1)
+
+    # Label nodes by their index
+    for i in range(len(x)):
+        plt.annotate(i,[x[i],y[i]],zorder=2,ha='center',va='center')
+
+    # Display edges by plotting lines
+    for e in edges:
+        i = e[0]
+        j = e[1]
+        plt.plot([x[i],x[j]],[y[i],y[j]],'k-',zorder = 0)
+
+    plt.show()
+
+
+# In[ ]:
+
+
+'''The Graph versions should agree with the Part 3 functions'''
+g = Graph(edges)
+assert(g.n == 6 and len(g.edges) == 10)
+assert(all(deg(i,g) == deg_reference(i,edges) for i in range(g.n)))
+assert(all(deg(i,edges) == deg(i,edges.tolist()) == deg_reference(i,edges) for i in range(g.n + 1)))
+assert(np.allclose(lap(g), lap_reference(edges)))
+
+'''Repeated and reversed edges are only stored once'''
+assert(len(Graph(np.concatenate([edges, edges[:,::-1]])).edges) == 10)
+'''and the node count uses both columns of the edge list'''
+assert(Graph([[5,0],[1,0]]).n == 6)
+
+'''Pinning nodes 0, 1 and 2 reproduces the layout from Part 4'''
+Lp, b, c = pin(g, [0,1,2], x, y)
+assert(np.allclose(np.linalg.solve(Lp.toarray(), b), x))
+assert(np.allclose(np.linalg.solve(Lp.toarray(), c), y))
+
+
+# In[ ]:
+
+
+graphplot(x,y,g)
+
+
+# ## Part 7: Solving Large Layouts Iteratively
+# 
+# Part 4 solves the pinned system with `np.linalg.solve`, which needs the dense n x n matrix and takes n³ steps. For large graphs we can instead solve it iteratively, which only ever multiplies by the sparse Laplacian.
+# 
+# First we take the pinned nodes out of the system entirely. Multiplying row i of the normalized Laplacian by deg(i) gives the combinatorial Laplacian K = D - A, which is symmetric. Splitting the nodes into free nodes f and pinned nodes p, the rows of the free nodes say
+# 
+# $$K_{ff} x_f = A_{fp} x_p$$
+# 
+# where $x_p$ are the known pinned coordinates. $K_{ff}$ is symmetric positive definite as long as every connected piece of the graph has at least one pinned node, so we can solve this with
+# 
+# * `'jacobi'`: move every free node to the average of its neighbors' positions, over and over, which is exactly the process described in Part 2,
+# * `'gauss-seidel'`: the same, but each node uses the already updated positions of the nodes before it,
+# * `'cg'`: the conjugate gradient method (with the degrees as a diagonal preconditioner), which usually needs far fewer iterations.
+# 
+# The pins are given as a dictionary `{node: (x, y)}`. The x and y coordinates are solved together as the two columns of one system. Each method stops when the residual of both columns is below `tol` relative to the right-hand side, or after `maxiter` iterations, and reports what happened in an `info` dictionary. Passing `x0` and `y0` starts from an earlier layout instead of putting every free node in the middle of the pins.
+
+# In[ ]:
+
+
+import scipy.sparse.linalg as spla
+
+def pin_arrays(pins):
+    pinned = np.array(sorted(pins), dtype=np.int64)
+    P = np.array([pins[i] for i in pinned], dtype=float).reshape(-1, 2)
+    return pinned, P
+
+
+def pinned_system(edges, pinned):
+    g = as_graph(edges)
+    is_pinned = np.zeros(g.n, dtype=bool)
+    is_pinned[pinned] = True
+    free = np.flatnonzero(~is_pinned)
+
+    # Rows of the free nodes in K = D - A, with the pinned columns B = A_fp moved to the right-hand side
+    A = g.adjacency()[free]
+    K = sp.diags(g.degree[free].astype(float)) - A[:, free]
+    return free, K.tocsr(), A[:, pinned].tocsr()
+
+
+def matvec(K, X):
+    return np.stack([K @ X[0], K @ X[1]])
+
+
+def iterate(K, rhs, X, method='cg', tol=1e-8, maxiter=10000):
+    d = np.maximum(K.diagonal(), 1)
+    X = np.array(X, dtype=float)
+    scale = np.linalg.norm(rhs, axis=1)
+    scale[scale == 0] = 1
+    R = rhs - matvec(K, X)
+    residual = np.linalg.norm(R, axis=1) / scale
+    iterations = 0
+
+    if method in ('cg', 'multilevel'):
+        # Precondition with the degrees, or with a multilevel V-cycle (Part 13)
+        if method == 'multilevel':
+            levels, coarse = multilevel(K)
+            precondition = lambda R: vcycle(levels, coarse, R)
+        else:
+            precondition = lambda R: R / d
+
+        Z = precondition(R)
+        D = Z.copy()
+        rz = np.einsum('ij,ij->i', R, Z)
+        while iterations < maxiter and residual.max() > tol:
+            Q = matvec(K, D)
+            dq = np.einsum('ij,ij->i', D, Q)
+            alpha = np.divide(rz, dq, out=np.zeros(2), where=dq > 0)[:,None]
+            X += alpha*D
+            R -= alpha*Q
+            Z = precondition(R)
+            rz_new = np.einsum('ij,ij->i', R, Z)
+            beta = np.divide(rz_new, rz, out=np.zeros(2), where=rz > 0)[:,None]
+            D = Z + beta*D
+            rz = rz_new
+            iterations += 1
+            residual = np.linalg.norm(R, axis=1) / scale
+    elif method == 'jacobi':
+        while iterations < maxiter and residual.max() > tol:
+            X += R / d
+            R = rhs - matvec(K, X)
+            iterations += 1
+            residual = np.linalg.norm(R, axis=1) / scale
+    elif method == 'gauss-seidel':
+        lower = sp.tril(K, format='csr')
+        upper = sp.triu(K, k=1, format='csr')
+        while iterations < maxiter and residual.max() > tol:
+            X = spla.spsolve_triangular(lower, (rhs - matvec(upper, X)).T, lower=True).T.copy()
+            R = rhs - matvec(K, X)
+            iterations += 1
+            residual = np.linalg.norm(R, axis=1) / scale
+    else:
+        raise ValueError("unknown method %r, expected 'cg', 'multilevel', 'jacobi' or 'gauss-seidel'" % method)
+
+    info = {'method': method, 'iterations': iterations,
+            'residual': float(residual.max()), 'converged': bool(residual.max() <= tol)}
+    return X, info
+
+
+def solve_iterative(edges, pins, method='cg', tol=1e-8, maxiter=10000, x0=None, y0=None):
+    g = as_graph(edges)
+    pinned, P = pin_arrays(pins)
+    free, K, B = pinned_system(g, pinned)
+
+    # The right-hand side holds the x column in row 0 and the y column in row 1
+    rhs = np.ascontiguousarray((B @ P).T)
+
+    # Start the free nodes at the previous layout, or in the middle of the pinned nodes
+    if x0 is not None and y0 is not None:
+        X = np.stack([np.asarray(x0, dtype=float)[free], np.asarray(y0, dtype=float)[free]])
+    else:
+        X = np.tile(P.mean(axis=0)[:,None], (1, len(free)))
+    X, info = iterate(K, rhs, X, method=method, tol=tol, maxiter=maxiter)
+
+    x = np.empty(g.n)
+    y = np.empty(g.n)
+    x[pinned], y[pinned] = P[:,0], P[:,1]
+    x[free], y[free] = X[0], X[1]
+    return x, y, info
+
+
+# To try this out on something bigger we need a graph whose correct layout we know. A rows x cols grid with its outside boundary pinned to the grid positions should lay out as the grid itself, since every inside node already sits at the average of its four neighbors.
+
+# In[ ]:
+
+
+def grid_graph(rows, cols):
+    node = np.arange(rows*cols).reshape(rows, cols)
+    across = np.stack([node[:,:-1].ravel(), node[:,1:].ravel()], axis=1)
+    down = np.stack([node[:-1,:].ravel(), node[1:,:].ravel()], axis=1)
+    return Graph(np.concatenate([across, down]))
+
+
+def grid_pins(rows, cols):
+    node = np.arange(rows*cols).reshape(rows, cols)
+    boundary = np.unique(np.concatenate([node[0], node[-1], node[:,0], node[:,-1]]))
+    return {i: (i % cols, i // cols) for i in boundary}
+
+
+# In[ ]:
+
+
+'''Every method should reproduce the layout from Part 4'''
+pins = {0: (0,0), 1: (0,1), 2: (1,1)}
+for method in ['cg', 'jacobi', 'gauss-seidel']:
+    xi, yi, info = solve_iterative(g, pins, method=method, tol=1e-10)
+    assert(info['converged'])
+    assert(np.allclose(xi, x) and np.allclose(yi, y))
+
+'''and a grid pinned on its boundary should lay out as the grid'''
+xg, yg, info = solve_iterative(grid_graph(30, 40), grid_pins(30, 40))
+assert(np.allclose(xg, np.arange(30*40) % 40) and np.allclose(yg, np.arange(30*40) // 40))
+
+
+# In[ ]:
+
+
+rows, cols = 300, 300
+start = time.perf_counter()
+xg, yg, info = solve_iterative(grid_graph(rows, cols), grid_pins(rows, cols), tol=1e-6)
+print(info, '%.2f s' % (time.perf_counter() - start))
+
+
+# ## Part 8: Factoring the Pinned Laplacian Once
+# 
+# Part 4 calls `np.linalg.solve(L,b)` and then `np.linalg.solve(L,c)`, and each call factors the same matrix L from scratch. We only need to factor it once: the x and y coordinates are just two right-hand sides of the same system, and a single sparse LU factorization of $K_{ff}$ can solve for both at the same time.
+# 
+# The factorization only depends on the graph and on *which* nodes are pinned, not on where they are pinned. If we keep it in a cache keyed by the graph's fingerprint and the set of pinned nodes, then moving the pinned nodes around and laying out the graph again only costs a pair of triangular solves. The `FactorCache` below keeps the `maxsize` most recently used factorizations, drops the least recently used one when it is full, and counts its `hits` and `misses`.
+
+# In[ ]:
+
+
+from collections import OrderedDict
+
+class FactorCache:
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+factor_cache = FactorCache()
+
+def solve_direct(edges, pins, cache=None):
+    g = as_graph(edges)
+    if cache is None:
+        cache = factor_cache
+    pinned, P = pin_arrays(pins)
+
+    key = (g.fingerprint, pinned.tobytes())
+    entry = cache.get(key)
+    if entry is None:
+        free, K, B = pinned_system(g, pinned)
+        lu = spla.splu(K.tocsc(), permc_spec='MMD_AT_PLUS_A',
+                       diag_pivot_thresh=0, options=dict(SymmetricMode=True))
+        entry = (free, B, lu)
+        cache.put(key, entry)
+    free, B, lu = entry
+
+    # Solve for the x and y columns together with the one factorization
+    X = lu.solve(B @ P)
+
+    x = np.empty(g.n)
+    y = np.empty(g.n)
+    x[pinned], y[pinned] = P[:,0], P[:,1]
+    x[free], y[free] = X[:,0], X[:,1]
+    return x, y
+
+
+# In[ ]:
+
+
+'''The direct solve should reproduce the layout from Part 4'''
+factor_cache.clear()
+xd, yd = solve_direct(g, {0: (0,0), 1: (0,1), 2: (1,1)})
+assert(np.allclose(xd, x) and np.allclose(yd, y))
+
+'''Moving the same pinned nodes should reuse the factorization'''
+xd, yd = solve_direct(Graph(edges), {0: (0,0), 1: (0,2), 2: (2,2)})
+assert(np.allclose(xd, 2*x) and np.allclose(yd, 2*y))
+assert(factor_cache.hits == 1 and factor_cache.misses == 1)
+
+'''but pinning a different set of nodes needs a new one'''
+solve_direct(g, {0: (0,0), 1: (0,1), 3: (1,1)})
+assert(factor_cache.misses == 2 and len(factor_cache) == 2)
+
+
+# The first layout of a graph pays for the factorization, and laying it out again with the pinned nodes moved only costs the triangular solves.
+
+# In[ ]:
+
+
+rows, cols = 300, 300
+grid = grid_graph(rows, cols)
+pins = grid_pins(rows, cols)
+
+start = time.perf_counter()
+xg, yg = solve_direct(grid, pins)
+print('factor and solve: %.3f s' % (time.perf_counter() - start))
+
+start = time.perf_counter()
+xg, yg = solve_direct(grid, {i: (2*px, py) for i, (px, py) in pins.items()})
+print('solve only:       %.3f s' % (time.perf_counter() - start))
+
+
+# ## Part 9: A Layout Function
+# 
+# Putting this together, `layout(edges, pins)` lays out a graph given as a `Graph` or an edge list, with the pinned nodes given as a dictionary `{node: (x, y)}`. Any set of nodes can be pinned, not just nodes 0, 1 and 2.
+# 
+# Part 4 replaced the rows of the pinned nodes in L with identity rows by looping over the whole matrix, and then still solved for all n nodes even though the pinned positions were already known. Along the way it also overwrote the `x` and `y` arrays, because `b = x` makes `b` another name for the same array rather than a copy. `layout` instead moves the pinned columns to the right-hand side and only solves the smaller system for the free nodes, and it never modifies the graph, the pins or any other array passed to it.
+# 
+# The `method` can be `'direct'` for the cached factorization from Part 8, or one of the iterative methods from Part 7, in which case `tol`, `maxiter`, `x0` and `y0` can also be passed. `layout` raises an error if an iterative method stops at `maxiter` before reaching `tol`, and, before solving anything, if some nodes are in a connected piece of the graph without any pinned node, since nothing fixes their positions (Part 14 shows how to lay out such graphs). Like the factorizations, the result of that check is kept in `component_checks` for each graph fingerprint and set of pinned nodes, so moving the pins of a graph that was already checked costs no more than the solve.
+
+# In[ ]:
+
+
+from scipy.sparse.csgraph import connected_components
+
+def check_pinned_pieces(adjacency, pinned):
+    # Every connected piece needs a pinned node, or its positions are not fixed by anything
+    count, label = connected_components(adjacency, directed=False)
+    loose = np.setdiff1d(np.arange(count), label[pinned])
+    if len(loose):
+        raise ValueError('nodes %s are not connected to any pinned node' % np.flatnonzero(np.isin(label, loose))[:10].tolist())
+
+
+# Graphs and sets of pinned nodes that passed the check, keyed like the factorizations
+component_checks = FactorCache(maxsize=64)
+
+def layout(edges, pins, method='direct', **options):
+    g = as_graph(edges)
+    if len(pins) == 0:
+        raise ValueError('at least one node must be pinned')
+    pinned = np.array(list(pins), dtype=np.int64)
+    if pinned.min() < 0 or pinned.max() >= g.n:
+        raise ValueError('pinned nodes must be between 0 and %d' % (g.n - 1))
+
+    # With every node pinned there is nothing left to solve
+    if len(np.unique(pinned)) == g.n:
+        pinned, P = pin_arrays(pins)
+        return P[:,0].copy(), P[:,1].copy()
+
+    key = (g.fingerprint, np.unique(pinned).tobytes())
+    if component_checks.get(key) is None:
+        check_pinned_pieces(g.adjacency(), pinned)
+        component_checks.put(key, True)
+
+    if method == 'direct':
+        return solve_direct(g, pins, **options)
+    x, y, info = solve_iterative(g, pins, method=method, **options)
+    if not info['converged']:
+        raise RuntimeError('%s did not converge in %d iterations, the residual is still %.3g'
+                           % (info['method'], info['iterations'], info['residual']))
+    return x, y
+
+
+# In[ ]:
+
+
+'''layout should reproduce Part 4 without changing its inputs'''
+edges_before = edges.copy()
+pins = {0: (0,0), 1: (0,1), 2: (1,1)}
+xl, yl = layout(edges, pins)
+assert(np.allclose(xl, x) and np.allclose(yl, y))
+assert(np.array_equal(edges, edges_before))
+assert(pins == {0: (0,0), 1: (0,1), 2: (1,1)})
+
+'''Any nodes can be pinned'''
+xl, yl = layout(edges, {3: (1,0), 4: (0.5,1), 5: (1,0.5)}, method='cg')
+assert(np.allclose(xl[[3,4,5]], [1,0.5,1]) and np.allclose(yl[[3,4,5]], [0,1,0.5]))
+assert(np.allclose(lap(edges)[[0,1,2]] @ xl, 0) and np.allclose(lap(edges)[[0,1,2]] @ yl, 0))
+
+'''Nodes that no pinned node can reach, and solves that stop before converging, are errors'''
+for method in ['direct', 'cg']:
+    try:
+        layout([[0,1],[1,2],[3,4]], {0: (0,0), 2: (1,1)}, method=method)
+        assert(False)
+    except ValueError as error:
+        assert('[3, 4]' in str(error))
+try:
+    layout(grid_graph(30, 30), grid_pins(30, 30), method='jacobi', maxiter=5)
+    assert(False)
+except RuntimeError as error:
+    assert('did not converge' in str(error))
+
+'''A graph and set of pinned nodes is only checked for loose pieces once'''
+component_checks.clear()
+layout(grid_graph(30, 30), grid_pins(30, 30))
+layout(grid_graph(30, 30), {i: (p[0] + 1, p[1]) for i, p in grid_pins(30, 30).items()})
+assert((component_checks.hits, component_checks.misses) == (1, 1))
+
+
+# In[ ]:
+
+
+graphplot(xl,yl,edges)
+
+
+# ## Part 10: Drawing Large Graphs
+# 
+# `graphplot` calls `plt.plot` once for every edge and `plt.annotate` once for every node, and each of those calls makes a separate matplotlib object that has to be created, stored and drawn. For a graph with tens of thousands of edges that takes minutes.
+# 
+# The version below hands all of the edges to matplotlib at once as a single `LineCollection`, built from an (E, 2, 2) array holding the two end points of every edge, and draws all of the nodes with a single `scatter`. The node labels are optional: by default they are only drawn for graphs with at most `label_limit` nodes, since on larger graphs they would just cover each other up, and larger graphs are also drawn with smaller nodes. Small graphs look the same as before.
+
+# In[ ]:
+
+
+from matplotlib.collections import LineCollection
+
+def graphplot(x,y,edges,labels=None,label_limit=100,node_size=None):
+    edges = as_graph(edges).edges
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if labels is None:
+        labels = len(x) <= label_limit
+    if node_size is None:
+        node_size = 500 if len(x) <= label_limit else 10
+
+    # Display all edges as one collection of line segments [[x_i,y_i],[x_j,y_j]]
+    segments = np.empty((len(edges), 2, 2))
+    segments[:,:,0] = x[edges]
+    segments[:,:,1] = y[edges]
+    ax = plt.gca()
+    ax.add_collection(LineCollection(segments, colors='black',
+                                     linewidths=plt.rcParams['lines.linewidth'], zorder=0))
+
+    # Display nodes as white disks with black borders
+    plt.scatter(x,y,
+                c='white',edgecolors='black',
+                s = node_size,zorder = 1)
+
+    # Label nodes by their index
+    if labels:
+        for i in range(len(x)):
+            ax.annotate(i,[x[i],y[i]],zorder=2,ha='center',va='center')
+
+    ax.autoscale_view()
+    plt.show()
+
+
+# In[ ]:
+
+
+graphplot(x,y,edges)
+
+
+# In[ ]:
+
+
+rows, cols = 150, 150
+grid = grid_graph(rows, cols)
+xg, yg = layout(grid, grid_pins(rows, cols))
+
+start = time.perf_counter()
+graphplot(xg, yg, grid)
+print('%d edges: %.2f s' % (len(grid.edges), time.perf_counter() - start))
+
+
+# ## Part 11: Updating a Layout as the Graph Changes
+# 
+# Often a graph changes only a little at a time: a few edges are added or removed, or a pinned node is moved. Rebuilding the Laplacian and solving again from scratch each time throws away almost everything we already know.
+# 
+# A `LayoutSession` keeps the reduced system $K_{ff} x_f = A_{fp} x_p$ from Part 7 between layouts. Adding or removing an edge [i,j] only changes the degrees of i and j, so only their rows of the system change: the diagonal entries of free end points, the entries between them if both are free, and the pinned column if one of them is pinned. Those entries are patched with a small sparse update. Moving pinned nodes only changes the right-hand side, unless the set of pinned nodes itself changes.
+# 
+# Each call to `layout()` then runs the iterative solver from Part 7 (through its `iterate` core) starting from the previous layout, so after a small change it only needs a few iterations to converge again. The solver statistics of the last layout are kept in `info`. Like `layout` from Part 9, `layout()` raises an error if the solver stops before converging, or if some free nodes can no longer reach any pinned node. That check runs again after every edge change or change of the pinned set, since removing an edge can cut a piece off.
+# 
+# With `method='direct'` the session keeps the sparse LU factorization of $K_{ff}$ from Part 8 instead, and only factors again after the edges or the set of pinned nodes change, so moving pinned nodes just costs two triangular solves.
+
+# In[ ]:
+
+
+class LayoutSession:
+    def __init__(self, edges, pins, method='cg', tol=1e-8, maxiter=10000):
+        g = as_graph(edges)
+        self.n = g.n
+        self.A = g.adjacency()
+        self.degree = g.degree.astype(np.int64)
+        self.method = method
+        self.tol = tol
+        self.maxiter = maxiter
+        self.x = None
+        self.y = None
+        self.info = None
+        self.pinned = None
+        self.checked = False
+        self.move_pins(pins)
+
+    def move_pins(self, pins):
+        pinned, P = pin_arrays(pins)
+        if len(pinned) == 0 or pinned.min() < 0 or pinned.max() >= self.n:
+            raise ValueError('pinned nodes must be between 0 and %d' % (self.n - 1))
+        if self.pinned is None or not np.array_equal(pinned, self.pinned):
+            self.reduce(pinned)
+        self.P = P
+
+    def reduce(self, pinned):
+        is_pinned = np.zeros(self.n, dtype=bool)
+        is_pinned[pinned] = True
+        self.pinned = pinned
+        self.free = np.flatnonzero(~is_pinned)
+
+        # Position of each node among the free nodes and among the pinned nodes, or -1
+        self.free_index = np.full(self.n, -1)
+        self.free_index[self.free] = np.arange(len(self.free))
+        self.pin_index = np.full(self.n, -1)
+        self.pin_index[pinned] = np.arange(len(pinned))
+
+        A = self.A[self.free]
+        self.K = (sp.diags(self.degree[self.free].astype(float)) - A[:, self.free]).tocsr()
+        self.B = A[:, pinned].tocsr()
+        self.lu = None
+        self.checked = False
+
+    def add_edges(self, edges):
+        self.change(edges, 1)
+
+    def remove_edges(self, edges):
+        self.change(edges, -1)
+
+    def change(self, edges, sign):
+        e = np.sort(np.asarray(edges, dtype=np.int64).reshape(-1, 2), axis=1)
+        e = np.unique(e[e[:,0] != e[:,1]], axis=0)
+        if len(e) == 0:
+            return
+        if e.min() < 0 or e.max() >= self.n:
+            raise ValueError('edges must connect nodes between 0 and %d' % (self.n - 1))
+        present = np.asarray(self.A[e[:,0], e[:,1]]).ravel() > 0
+        if sign > 0:
+            e = e[~present]
+        elif not present.all():
+            raise ValueError('edge %s is not in the graph' % list(e[~present][0]))
+        i = np.concatenate([e[:,0], e[:,1]])
+        j = np.concatenate([e[:,1], e[:,0]])
+
+        # Patch the adjacency and the degrees of the end points
+        ones = np.full(len(i), float(sign))
+        self.A = self.A + sp.csr_matrix((ones, (i, j)), shape=self.A.shape)
+        np.add.at(self.degree, i, sign)
+
+        # Patch the rows of the free end points: their diagonal, their free neighbors and their pinned neighbors
+        fi, fj, pj = self.free_index[i], self.free_index[j], self.pin_index[j]
+        diag = fi >= 0
+        both = diag & (fj >= 0)
+        to_pin = diag & (pj >= 0)
+        nf = len(self.free)
+        self.K = self.K + sp.csr_matrix(
+            (np.concatenate([ones[diag], -ones[both]]),
+             (np.concatenate([fi[diag], fi[both]]), np.concatenate([fi[diag], fj[both]]))), shape=(nf, nf))
+        self.B = self.B + sp.csr_matrix((ones[to_pin], (fi[to_pin], pj[to_pin])), shape=self.B.shape)
+        if sign < 0:
+            self.A.eliminate_zeros()
+            self.K.eliminate_zeros()
+            self.B.eliminate_zeros()
+        self.lu = None
+        self.checked = False
+
+    def graph(self):
+        i, j = sp.triu(self.A).nonzero()
+        return Graph(np.stack([i, j], axis=1), n=self.n)
+
+    def layout(self):
+        # Removing edges or pinning other nodes can leave a piece with no pinned node
+        if not self.checked:
+            check_pinned_pieces(self.A, self.pinned)
+            self.checked = True
+        rhs = np.ascontiguousarray((self.B @ self.P).T)
+
+        if self.method == 'direct':
+            # Keep the factorization of K until the edges or the set of pinned nodes change
+            if self.lu is None:
+                self.lu = spla.splu(self.K.tocsc(), permc_spec='MMD_AT_PLUS_A',
+                                    diag_pivot_thresh=0, options=dict(SymmetricMode=True))
+            X = self.lu.solve(np.ascontiguousarray(rhs.T)).T
+            scale = np.linalg.norm(rhs, axis=1)
+            scale[scale == 0] = 1
+            residual = float((np.linalg.norm(rhs - matvec(self.K, X), axis=1) / scale).max())
+            self.info = {'method': 'direct', 'iterations': 0, 'residual': residual, 'converged': residual <= self.tol}
+        else:
+            # Start from the previous layout if there is one
+            if self.x is None:
+                X = np.tile(self.P.mean(axis=0)[:,None], (1, len(self.free)))
+            else:
+                X = np.stack([self.x[self.free], self.y[self.free]])
+            X, self.info = iterate(self.K, rhs, X, method=self.method, tol=self.tol, maxiter=self.maxiter)
+        if not self.info['converged']:
+            raise RuntimeError('%s did not converge in %d iterations, the residual is still %.3g'
+                               % (self.info['method'], self.info['iterations'], self.info['residual']))
+
+        self.x = np.empty(self.n)
+        self.y = np.empty(self.n)
+        self.x[self.pinned], self.y[self.pinned] = self.P[:,0], self.P[:,1]
+        self.x[self.free], self.y[self.free] = X[0], X[1]
+        return self.x.copy(), self.y.copy()
+
+
+# In[ ]:
+
+
+'''A session should match a fresh layout after every change'''
+session = LayoutSession(edges, {0: (0,0), 1: (0,1), 2: (1,1)})
+xs, ys = session.layout()
+assert(np.allclose(xs, x) and np.allclose(ys, y))
+
+session.remove_edges([[5,0]])
+session.add_edges([[3,5],[2,3]])
+changed = np.concatenate([edges[(edges != [0,5]).any(axis=1)], [[3,5],[2,3]]])
+xs, ys = session.layout()
+xl, yl = layout(changed, {0: (0,0), 1: (0,1), 2: (1,1)})
+assert(np.allclose(xs, xl) and np.allclose(ys, yl))
+assert(np.array_equal(session.graph().edges, Graph(changed).edges))
+
+session.move_pins({0: (0,0), 1: (0,1), 4: (1,0)})
+xs, ys = session.layout()
+xl, yl = layout(changed, {0: (0,0), 1: (0,1), 4: (1,0)})
+assert(np.allclose(xs, xl) and np.allclose(ys, yl))
+
+'''Removing an edge that cuts free nodes off from every pinned node is an error, until they are joined again'''
+for method in ['cg', 'direct']:
+    session = LayoutSession([[0,1],[1,2],[2,3],[3,4]], {0: (0,0), 1: (1,0)}, method=method)
+    session.layout()
+    session.remove_edges([[1,2]])
+    try:
+        session.layout()
+        assert(False)
+    except ValueError as error:
+        assert('[2, 3, 4]' in str(error))
+    session.add_edges([[0,4]])
+    xs, ys = session.layout()
+    assert(np.allclose(xs, [0, 1, 0, 0, 0]) and np.allclose(ys, 0))
+'''and so is a solve that stops before converging'''
+session = LayoutSession(grid_graph(30, 30), grid_pins(30, 30), method='jacobi', maxiter=5)
+try:
+    session.layout()
+    assert(False)
+except RuntimeError as error:
+    assert('did not converge' in str(error))
+
+
+# After a few edges are added to a large grid, the updated layout starts from the previous one and converges again in far fewer iterations than the first layout took.
+
+# In[ ]:
+
+
+rows, cols = 300, 300
+session = LayoutSession(grid_graph(rows, cols), grid_pins(rows, cols), tol=1e-6)
+
+start = time.perf_counter()
+session.layout()
+print('first layout: ', session.info['iterations'], 'iterations, %.3f s' % (time.perf_counter() - start))
+
+start = time.perf_counter()
+corner = np.arange(140, 150)*cols + 140
+session.add_edges(np.stack([corner, corner + cols + 1], axis=1))
+session.layout()
+print('after update: ', session.info['iterations'], 'iterations, %.3f s' % (time.perf_counter() - start))
+
+
+# ## Part 12: Loading Large Edge Lists from Disk
+# 
+# So far every edge list has been an `np.array` built in memory, often from a Python list of lists. For a graph with a hundred million edges, just building that array is already the slow part, and a Python list of pairs would take many gigabytes.
+# 
+# `read_edge_chunks` reads an edge list from a file a piece at a time instead. A text file has one edge per line, as two whitespace separated node indices (any further columns are ignored, and lines starting with `#` are comments). A binary file is a flat array of int32 (or int64) node index pairs, which is memory mapped with `np.memmap` so only the piece being worked on is read into memory.
+# 
+# `load_graph` builds a `Graph` from such a file in two passes over the chunks. The first pass only counts the degree of every node. That tells us exactly where each node's neighbors go in the CSR `indices` array, so the second pass can drop every edge straight into its place. Both passes count only the nodes that appear in the chunk at hand (with `np.unique`), so the work per chunk does not grow with the number of nodes, and apart from the graph itself, only one chunk of edges is ever held in memory. Like `Graph`, `Graph.from_csr` leaves out self loops. The file should not list an edge more than once, since repeats are only merged at the end, after they have already taken up space.
+
+# In[ ]:
+
+
+import io
+
+def read_edge_chunks(path, binary=False, dtype=np.int32, chunk_edges=1<<20):
+    if binary:
+        pairs = np.memmap(path, dtype=dtype, mode='r').reshape(-1, 2)
+        for start in range(0, len(pairs), chunk_edges):
+            yield np.array(pairs[start:start+chunk_edges], dtype=np.int64)
+        return
+
+    with open(path, 'rb') as f:
+        rest = b''
+        while True:
+            block = f.read(chunk_edges*16)
+            if not block:
+                break
+            # Only parse whole lines, and carry the partial last line over to the next block
+            block = rest + block
+            cut = block.rfind(b'\n') + 1
+            block, rest = block[:cut], block[cut:]
+            if cut:
+                yield np.loadtxt(io.BytesIO(block), dtype=np.int64, comments='#', usecols=(0,1), ndmin=2)
+        if rest.strip():
+            yield np.loadtxt(io.BytesIO(rest), dtype=np.int64, comments='#', usecols=(0,1), ndmin=2)
+
+
+def load_graph(path, binary=False, dtype=np.int32, n=None, chunk_edges=1<<20):
+    # First pass: count the degree of every node, growing the count array as larger nodes show up
+    degree = np.zeros(0 if n is None else n, dtype=np.int64)
+    for e in read_edge_chunks(path, binary, dtype, chunk_edges):
+        e = e[e[:,0] != e[:,1]]
+        if len(e) == 0:
+            continue
+        if e.min() < 0:
+            raise ValueError('node indices must not be negative')
+        # Counting only the nodes in the chunk keeps each chunk's work independent of n
+        node, count = np.unique(e, return_counts=True)
+        if node[-1] >= len(degree):
+            if n is not None:
+                raise ValueError('edge list refers to node %d but the graph has only %d nodes' % (node[-1], n))
+            degree = np.concatenate([degree, np.zeros(node[-1] + 1 - len(degree), dtype=np.int64)])
+        degree[node] += count
+    n = len(degree)
+
+    # Second pass: each node's neighbors go in indices[indptr[i]:indptr[i+1]], filled from the left
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(degree, out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    fill = indptr[:-1].copy()
+    for e in read_edge_chunks(path, binary, dtype, chunk_edges):
+        e = e[e[:,0] != e[:,1]]
+        src = np.concatenate([e[:,0], e[:,1]])
+        dst = np.concatenate([e[:,1], e[:,0]])
+        order = np.argsort(src, kind='stable')
+        src = src[order]
+
+        # The k-th neighbor of a node within this chunk goes k places after its fill position
+        rank = np.arange(len(src)) - np.searchsorted(src, src)
+        indices[fill[src] + rank] = dst[order]
+        node, count = np.unique(src, return_counts=True)
+        fill[node] += count
+
+    return Graph.from_csr(indptr, indices, n)
+
+
+# In[ ]:
+
+
+'''Loading a grid from a text or a binary file should give the same graph'''
+import os
+import tempfile
+
+grid = grid_graph(40, 30)
+with tempfile.TemporaryDirectory() as folder:
+    text_path = os.path.join(folder, 'grid.txt')
+    with open(text_path, 'w') as f:
+        f.write('# a 40 x 30 grid\n')
+        for i, j in grid.edges[::-1]:
+            f.write('%d %d\n' % (j, i))
+    binary_path = os.path.join(folder, 'grid.bin')
+    grid.edges.tofile(binary_path)
+
+    for loaded in [load_graph(text_path, chunk_edges=100), load_graph(binary_path, binary=True, chunk_edges=100)]:
+        assert(loaded.fingerprint == grid.fingerprint)
+        assert(np.array_equal(loaded.edges, grid.edges) and np.array_equal(loaded.degree, grid.degree))
+        assert(np.allclose(lap_sparse(loaded).toarray(), lap_sparse(grid).toarray()))
+
+'''Self loops are left out of a CSR graph, as they are from Graph'''
+looped = Graph.from_csr([0,2,3,4], [0,1,0,2])
+assert(np.array_equal(looped.degree, Graph([[0,1],[0,0],[2,2]], n=3).degree) and looped.edges.tolist() == [[0,1]])
+
+
+# In[ ]:
+
+
+with tempfile.TemporaryDirectory() as folder:
+    path = os.path.join(folder, 'big.bin')
+    big = grid_graph(1000, 1000)
+    big.edges.tofile(path)
+
+    start = time.perf_counter()
+    loaded = load_graph(path, binary=True)
+    print(loaded, '%.2f s' % (time.perf_counter() - start))
+    del loaded
+
+
+# ## Part 13: A Multilevel Solver
+# 
+# Moving every node to the average of its neighbors fixes the small wiggles in a layout very quickly, but a large smooth error, like a whole region of the graph sitting too far to the left, only shrinks a little with each sweep, because the information has to travel across the graph one edge at a time. That is why the iteration counts in Part 7 grow with the size of the grid.
+# 
+# A multilevel solver fixes those smooth errors on a smaller version of the graph instead:
+# 
+# 1. **Coarsen**: pair up each free node with the neighbor it is most strongly connected to (a matching), twice, so that groups of about four nodes become single nodes of a coarser graph. The coarse system is $P^T K_{ff} P$, where P maps each node to its group, and its off-diagonal entries count the edges between groups. This is repeated until the graph has at most `coarse_size` nodes.
+# 2. **Smooth and restrict**: a couple of damped Jacobi sweeps (moving each node part of the way to the average of its neighbors) on the fine graph, then the remaining residual is summed up over each group.
+# 3. **Solve** the small system on the coarsest graph directly.
+# 4. **Prolong and smooth**: every node in a group moves by its group's correction, followed by a couple more Jacobi sweeps.
+# 
+# Only the free nodes are ever coarsened. The pinned nodes were already moved to the right-hand side, so they stay fixed at their positions on every level. One such V-cycle is used as the preconditioner for the conjugate gradient method, which keeps the number of iterations almost the same as the graph grows.
+# 
+# `iterate`, `solve_iterative`, `layout` and `LayoutSession` all accept `method='multilevel'`.
+
+# In[ ]:
+
+
+def match(K, rng, rounds=4):
+    n = K.shape[0]
+    rows = np.repeat(np.arange(n), np.diff(K.indptr))
+    empty = np.diff(K.indptr) == 0
+
+    # Off-diagonal connection strengths, with a little noise to break ties
+    w = -K.data * (1 + 0.1*rng.random(K.nnz))
+    w[rows == K.indices] = -1
+
+    # Each unmatched node picks its most strongly connected unmatched neighbor, and nodes that pick each other are paired
+    agg = np.full(n, -1)
+    count = 0
+    for r in range(rounds):
+        unmatched = agg < 0
+        key = np.where(unmatched[rows] & unmatched[K.indices], w, -1.0)
+        best = np.maximum.reduceat(np.append(key, -1.0), K.indptr[:-1])
+        best[empty] = -1
+        hit = (key > 0) & (key == best[rows])
+        choice = np.full(n, -1)
+        choice[rows[hit]] = K.indices[hit]
+
+        i = np.flatnonzero(choice >= 0)
+        i = i[(choice[choice[i]] == i) & (i < choice[i])]
+        if len(i) == 0:
+            break
+        agg[i] = count + np.arange(len(i))
+        agg[choice[i]] = agg[i]
+        count += len(i)
+
+    # Nodes left over become groups of their own
+    left = np.flatnonzero(agg < 0)
+    agg[left] = count + np.arange(len(left))
+    return agg
+
+
+def multilevel(K, coarse_size=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    levels = []
+    while K.shape[0] > coarse_size:
+        n = K.shape[0]
+        P = sp.identity(n, format='csr')
+        Kc = K
+        for r in range(2):
+            agg = match(Kc, rng)
+            Pr = sp.csr_matrix((np.ones(len(agg)), (np.arange(len(agg)), agg)), shape=(len(agg), agg.max() + 1))
+            P = (P @ Pr).tocsr()
+            Kc = (Pr.T @ Kc @ Pr).tocsr()
+        if Kc.shape[0] > 0.8*n:
+            break
+        diagonal = K.diagonal()
+        levels.append((K, P, P.T.tocsr(), np.divide(1.0, diagonal, out=np.zeros(n), where=diagonal > 0)))
+        K = Kc
+    return levels, spla.splu(K.tocsc())
+
+
+def vcycle(levels, coarse, R, level=0, sweeps=2, omega=2/3, scale=1.8):
+    if level == len(levels):
+        return coarse.solve(np.ascontiguousarray(R.T)).T
+    K, P, Pt, dinv = levels[level]
+
+    X = omega*dinv*R
+    for s in range(sweeps - 1):
+        X += omega*dinv*(R - matvec(K, X))
+
+    # Correct each group by the coarse solution, scaled up a little since groups move as a whole
+    X += scale*matvec(P, vcycle(levels, coarse, matvec(Pt, R - matvec(K, X)), level + 1, sweeps, omega, scale))
+
+    for s in range(sweeps):
+        X += omega*dinv*(R - matvec(K, X))
+    return X
+
+
+# In[ ]:
+
+
+'''The multilevel solver should reproduce Part 4 and the grid layout'''
+xm, ym = layout(edges, {0: (0,0), 1: (0,1), 2: (1,1)}, method='multilevel')
+assert(np.allclose(xm, x) and np.allclose(ym, y))
+
+xm, ym, info = solve_iterative(grid_graph(80, 90), grid_pins(80, 90), method='multilevel')
+assert(info['converged'])
+assert(np.allclose(xm, np.arange(80*90) % 90) and np.allclose(ym, np.arange(80*90) // 90))
+
+
+# The number of multilevel iterations barely changes as the grid gets bigger, while plain conjugate gradients needs more and more.
+
+# In[ ]:
+
+
+for size in [100, 200, 400]:
+    grid = grid_graph(size, size)
+    pins = grid_pins(size, size)
+    for method in ['cg', 'multilevel']:
+        start = time.perf_counter()
+        xm, ym, info = solve_iterative(grid, pins, method=method, tol=1e-6)
+        print('%d x %d %-10s %4d iterations %6.2f s' % (size, size, method, info['iterations'], time.perf_counter() - start))
+
+
+# ## Part 14: Disconnected Graphs and Many Graphs at Once
+# 
+# Back in Part 3 we assumed the graph was connected. If it is not, every connected piece of the graph needs pinned nodes of its own: a piece without any pinned nodes has no positions to average towards, and its part of the system has no unique solution.
+# 
+# `split_components` finds the connected pieces of a graph with SciPy's `connected_components`, which runs a breadth first search over the CSR adjacency. It then renumbers the nodes of each piece from zero and hands back, for every piece, its nodes, its renumbered edges and the pins that fall in it. Pieces with pins of their own keep them. A piece without pins gets its first three nodes pinned to (0,0), (0,1) and (1,1) like in Part 4, and is moved to its own spot in a grid of such pieces to the right of everything else, so that the pieces do not lie on top of each other. `layout_components` lays out each piece and puts the results back together.
+# 
+# `batch_layout` does the same for a whole list of graphs, spreading the graphs over a pool of worker processes. The parent process only counts the nodes of each graph to know where its rows go, and the workers build, split and lay out the graphs themselves, so none of that work is left to be done one graph at a time in the parent. Every worker writes its coordinates straight into one shared memory array, so the results never have to be sent back through the pool. The worker processes need to see the functions defined in this notebook, so the pool always starts them by forking this process (`multiprocessing.get_context('fork')`), which works on Linux and macOS but not on Windows. Newer versions of Python no longer fork by default, so we ask for it.
+
+# In[ ]:
+
+
+from scipy.sparse.csgraph import connected_components
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+def split_components(edges, pins=None):
+    g = as_graph(edges)
+    count, label = connected_components(g.adjacency(), directed=False)
+
+    # Number the nodes of each piece from zero, in their original order
+    order = np.argsort(label, kind='stable')
+    start = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(label, minlength=count), out=start[1:])
+    local = np.empty(g.n, dtype=np.int64)
+    local[order] = np.arange(g.n) - start[label[order]]
+
+    # Group the edges by the piece they belong to
+    edge_label = label[g.edges[:,0]]
+    edge_order = np.argsort(edge_label, kind='stable')
+    edge_start = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edge_label, minlength=count), out=edge_start[1:])
+    local_edges = local[g.edges[edge_order]]
+
+    piece_pins = {}
+    for i, position in (pins or {}).items():
+        piece_pins.setdefault(label[i], {})[int(local[i])] = position
+
+    # Pieces without pins are laid out in unit squares on a grid to the right of the pinned pieces
+    unpinned = [c for c in range(count) if c not in piece_pins]
+    width = max(1, int(np.ceil(np.sqrt(len(unpinned)))))
+    left = max([p[0] for p in (pins or {}).values()], default=-1.5) + 1.5
+    shift = {c: (left + 1.5*(k % width), 1.5*(k // width)) for k, c in enumerate(unpinned)}
+
+    pieces = []
+    for c in range(count):
+        nodes = order[start[c]:start[c+1]]
+        pieces.append((nodes, local_edges[edge_start[c]:edge_start[c+1]], piece_pins.get(c, {}), shift.get(c, (0, 0))))
+    return pieces
+
+
+def layout_piece(n, edges, pins, method='direct'):
+    if not pins:
+        if n == 1:
+            return np.array([0.5]), np.array([0.5])
+        corners = [(0,0), (0,1), (1,1)] if n > 2 else [(0,0), (1,1)]
+        pins = {i: corners[i] for i in range(len(corners))}
+    return layout(Graph(edges, n=n), pins, method=method)
+
+
+def layout_components(edges, pins=None, method='direct'):
+    g = as_graph(edges)
+    x = np.empty(g.n)
+    y = np.empty(g.n)
+    for nodes, e, p, shift in split_components(g, pins):
+        x[nodes], y[nodes] = layout_piece(len(nodes), e, p, method)
+        x[nodes] += shift[0]
+        y[nodes] += shift[1]
+    return x, y
+
+
+def node_count(edges):
+    # The number of nodes Graph(edges) would have, without building it
+    if isinstance(edges, Graph):
+        return edges.n
+    edges = np.asarray(edges).reshape(-1, 2)
+    edges = edges[edges[:,0] != edges[:,1]]
+    return int(edges.max()) + 1 if len(edges) else 0
+
+
+def layout_graphs(name, total, jobs, method):
+    # Runs in a worker process: split each graph into pieces, lay them out and write them into the shared coordinate array
+    memory = shared_memory.SharedMemory(name=name)
+    xy = np.ndarray((total, 2), buffer=memory.buf)
+    for edges, pins, start in jobs:
+        for nodes, e, p, shift in split_components(edges, pins):
+            xp, yp = layout_piece(len(nodes), e, p, method)
+            xy[start + nodes,0] = xp + shift[0]
+            xy[start + nodes,1] = yp + shift[1]
+    del xy
+    memory.close()
+
+
+def batch_layout(graphs, pins=None, method='direct', max_workers=None, graphs_per_task=32):
+    if pins is None:
+        pins = [None]*len(graphs)
+    offset = np.zeros(len(graphs) + 1, dtype=np.int64)
+    np.cumsum([node_count(g) for g in graphs], out=offset[1:])
+    total = int(offset[-1])
+
+    # The workers get whole graphs with the first row of the shared array they fill in, and split them themselves
+    jobs = list(zip(graphs, pins, offset[:-1]))
+    tasks = [jobs[k:k+graphs_per_task] for k in range(0, len(jobs), graphs_per_task)]
+
+    memory = shared_memory.SharedMemory(create=True, size=max(total, 1)*2*8)
+    try:
+        xy = np.ndarray((total, 2), buffer=memory.buf)
+        with ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('fork')) as pool:
+            list(pool.map(layout_graphs, [memory.name]*len(tasks), [total]*len(tasks), tasks, [method]*len(tasks)))
+        results = [(xy[a:b,0].copy(), xy[a:b,1].copy()) for a, b in zip(offset[:-1], offset[1:])]
+        del xy
+    finally:
+        memory.close()
+        memory.unlink()
+    return results
+
+
+# In[ ]:
+
+
+'''Each piece of a disconnected graph should get its own layout'''
+apart = np.concatenate([edges, edges + 6, [[12,13]], [[14,15],[15,16],[16,14],[16,17]]])
+pieces = split_components(apart, {0: (0,0), 1: (0,1), 2: (1,1)})
+assert(len(pieces) == 4 and [len(p[0]) for p in pieces] == [6, 6, 2, 4])
+
+xc, yc = layout_components(apart, {0: (0,0), 1: (0,1), 2: (1,1)})
+assert(np.allclose(xc[:6], x) and np.allclose(yc[:6], y))
+assert(np.allclose(xc[6:12] - xc[6], x) and np.allclose(yc[6:12] - yc[6], y))
+'''Every free node sits at the average of its neighbors'''
+free = np.setdiff1d(np.arange(18), [0,1,2, 6,7,8, 12,13, 14,15,16])
+assert(np.allclose(lap(apart)[free] @ xc, 0) and np.allclose(lap(apart)[free] @ yc, 0))
+'''and the pieces without pins do not overlap'''
+assert(len({(int(xc[i] // 1.5), int(yc[i] // 1.5)) for i in [6, 12, 14]}) == 3)
+
+'''A batch layout should give the same result as laying out each graph on its own'''
+batch = batch_layout([apart, edges, grid_graph(5, 5)], pins=[None, {0: (0,0), 1: (0,1), 2: (1,1)}, None], max_workers=2)
+assert(np.allclose(batch[0][0], layout_components(apart)[0]) and np.allclose(batch[0][1], layout_components(apart)[1]))
+assert(np.allclose(batch[1][0], x) and np.allclose(batch[1][1], y))
+
+
+# Laying out a few thousand small random graphs serially and with a pool of worker processes:
+
+# In[ ]:
+
+
+rng = np.random.default_rng(416)
+graphs = [rng.integers(0, 40, size=(60, 2)) for k in range(2000)]
+
+start = time.perf_counter()
+serial = [layout_components(e) for e in graphs]
+print('serial:   %.2f s' % (time.perf_counter() - start))
+
+start = time.perf_counter()
+parallel = batch_layout(graphs)
+print('parallel: %.2f s' % (time.perf_counter() - start))
+assert(all(np.allclose(a[0], b[0]) and np.allclose(a[1], b[1]) for a, b in zip(serial, parallel)))
+
+
+# ## Part 15: Counting Edge Crossings
+# 
+# Part 3 promised that the pinned Laplacian gives a layout without edge crossings if one exists, but so far the only way to check that has been to look at the plot. `count_crossings(x, y, edges)` checks it for us and returns the number of crossings together with the pairs of edges that cross.
+# 
+# Testing every pair of edges would take $O(E^2)$ time, which is far too slow for a large graph. Instead we lay a uniform grid of square cells over the drawing and list every edge in each cell its bounding box touches. Only edges that share a cell can cross, so we only test those pairs. The cells start out about as big as a typical edge and are made bigger if the long edges would cover too many of them. A pair of edges that shares several cells is only tested in the cell holding the lower left corner of where their bounding boxes overlap, so every pair is tested once.
+# 
+# A crowded cell would still make us test every pair of its edges. Two things keep that in check. Edges that share a node cannot cross, so in every cell we find the node shared by the most of its edges (for a star, the center) and never pair up two edges that share it. A cell that still has more than `limit` pairs is split into 4 x 4 smaller cells and handled the same way, up to `depth` times, unless its edges are so long that they would cover most of the smaller cells anyway.
+# 
+# Two edges cross when the ends of each edge lie on opposite sides of the line through the other one, which we can tell from the sign of a cross product. Edges that share a node, or that only touch or lie along the same line, are not counted as crossings. A small tolerance keeps rounding errors in the solved coordinates from turning touching edges into crossings.
+
+# In[ ]:
+
+
+def orientation(a, b, c):
+    # Positive when c is to the left of the line from a to b, negative when it is to the right
+    return (b[:,0] - a[:,0])*(c[:,1] - a[:,1]) - (b[:,1] - a[:,1])*(c[:,0] - a[:,0])
+
+
+def segments_cross(s, t, tol=0.0):
+    # s and t hold matching lists of segments as (m, 2, 2) arrays of end points
+    def apart(o1, o2):
+        return ((o1 > tol) & (o2 < -tol)) | ((o1 < -tol) & (o2 > tol))
+    return (apart(orientation(s[:,0], s[:,1], t[:,0]), orientation(s[:,0], s[:,1], t[:,1])) &
+            apart(orientation(t[:,0], t[:,1], s[:,0]), orientation(t[:,0], t[:,1], s[:,1])))
+
+
+def cell_pairs(low, high, e, ids, origin, size, box, limit, depth):
+    # Candidate pairs among the edges ids whose box overlap has its corner in the cells box = (x0, y0, x1, y1)
+    lo = np.maximum(np.floor((low[ids] - origin)/size).astype(np.int64), box[:2])
+    hi = np.minimum(np.floor((high[ids] - origin)/size).astype(np.int64), box[2:])
+    span = hi - lo + 1
+    cover = span[:,0]*span[:,1]
+    columns = box[2] - box[0] + 1
+
+    # One entry for every cell that every edge covers
+    k = np.repeat(np.arange(len(ids)), cover)
+    step = np.arange(len(k)) - np.repeat(np.cumsum(cover) - cover, cover)
+    cx = lo[k,0] + step % span[k,0]
+    cy = lo[k,1] + step // span[k,0]
+    edge = ids[k]
+    cell = (cy - box[1])*columns + (cx - box[0])
+
+    # The hub of a cell is the node most of its edges share, and edges sharing it cannot cross each other
+    n = int(e.max()) + 1
+    key, count = np.unique(np.concatenate([cell*n + e[edge,0], cell*n + e[edge,1]]), return_counts=True)
+    best = key[np.lexsort((count, key // n))]
+    last = np.r_[best[1:] // n != best[:-1] // n, True]
+    hubs = (best[last] % n)[np.searchsorted(best[last] // n, cell)]
+    in_hub = (e[edge,0] == hubs) | (e[edge,1] == hubs)
+
+    # Sort by cell, with the edges of the hub last
+    order = np.lexsort((in_hub, cell))
+    edge, cx, cy, cell, in_hub = edge[order], cx[order], cy[order], cell[order], in_hub[order]
+    first = np.flatnonzero(np.r_[True, cell[1:] != cell[:-1]])
+    size_of = np.diff(np.append(first, len(cell)))
+    in_hub_of = np.add.reduceat(in_hub.astype(np.int64), first) if len(cell) else np.empty(0, dtype=np.int64)
+    pairs_of = size_of*(size_of - 1)//2 - in_hub_of*(in_hub_of - 1)//2
+
+    # Cells with too many pairs are split into 4 x 4 smaller cells, unless their edges would cover most of those anyway
+    a, b = [], []
+    split = np.zeros(len(cell), dtype=bool)
+    for c in np.flatnonzero((pairs_of > limit) & (depth > 0)):
+        inside = edge[first[c]:first[c] + size_of[c]]
+        x0, y0 = cx[first[c]], cy[first[c]]
+        sub_box = np.array([4*x0, 4*y0, 4*x0 + 3, 4*y0 + 3])
+        sub_lo = np.maximum(np.floor((low[inside] - origin)/(size/4)).astype(np.int64), sub_box[:2])
+        sub_hi = np.minimum(np.floor((high[inside] - origin)/(size/4)).astype(np.int64), sub_box[2:])
+        if (sub_hi - sub_lo + 1).prod(axis=1).mean() > 2:
+            continue
+        sub = cell_pairs(low, high, e, inside, origin, size/4, sub_box, limit, depth - 1)
+        a.append(sub[0])
+        b.append(sub[1])
+        split[first[c]:first[c] + size_of[c]] = True
+
+    # Pair every entry of the other cells with the entries after it, leaving out pairs of hub edges
+    end = np.repeat(first + size_of, size_of)
+    later = np.where(in_hub | split, 0, end - np.arange(len(cell)) - 1)
+    i = np.repeat(np.arange(len(cell)), later)
+    j = i + 1 + np.arange(len(i)) - np.repeat(np.cumsum(later) - later, later)
+    p, q = edge[i], edge[j]
+
+    # Keep pairs whose boxes overlap, tested only in the cell holding the corner of the overlap, that share no nodes
+    corner = np.floor((np.maximum(low[p], low[q]) - origin)/size).astype(np.int64)
+    keep = ((low[p] <= high[q]).all(axis=1) & (low[q] <= high[p]).all(axis=1) &
+            (corner[:,0] == cx[i]) & (corner[:,1] == cy[i]) &
+            (e[p,0] != e[q,0]) & (e[p,0] != e[q,1]) & (e[p,1] != e[q,0]) & (e[p,1] != e[q,1]))
+    return np.concatenate(a + [p[keep]]), np.concatenate(b + [q[keep]])
+
+
+def count_crossings(x, y, edges, eps=1e-9, limit=4096, depth=6):
+    e = as_graph(edges).edges
+    m = len(e)
+    if m < 2:
+        return 0, np.empty((0, 2, 2), dtype=e.dtype)
+    seg = np.stack([x, y], axis=1)[e]
+    low = seg.min(axis=1)
+    high = seg.max(axis=1)
+    origin = low.min(axis=0)
+    extent = max((high.max(axis=0) - origin).max(), 1e-300)
+    tol = eps*extent**2
+
+    # Pick the cell size, doubling it while the edges would cover too many cells
+    size = max(np.median((high - low).max(axis=1)), extent/np.sqrt(m))
+    while True:
+        lo = np.floor((low - origin)/size).astype(np.int64)
+        hi = np.floor((high - origin)/size).astype(np.int64)
+        span = hi - lo + 1
+        if (span[:,0]*span[:,1]).sum() <= 16*m:
+            break
+        size *= 2
+
+    a, b = cell_pairs(low, high, e, np.arange(m), origin, size, np.r_[0, 0, hi.max(axis=0)], limit, depth)
+    a, b = np.minimum(a, b), np.maximum(a, b)
+    hit = segments_cross(seg[a], seg[b], tol)
+    return int(hit.sum()), np.stack([e[a[hit]], e[b[hit]]], axis=1)
+
+
+# In[ ]:
+
+
+'''The layouts from the earlier parts should not have any crossings'''
+assert(count_crossings(x, y, edges)[0] == 0)
+xg, yg = layout(grid_graph(30, 40), grid_pins(30, 40))
+assert(count_crossings(xg, yg, grid_graph(30, 40))[0] == 0)
+
+'''A square with both of its diagonals has exactly one crossing'''
+count, pairs = count_crossings(np.array([0., 1., 1., 0.]), np.array([0., 0., 1., 1.]), [[0,1],[1,2],[2,3],[3,0],[0,2],[1,3]])
+assert(count == 1 and sorted(map(tuple, pairs[0])) == [(0,2), (1,3)])
+'''while pinning three of its corners and solving for the fourth draws the same graph without any'''
+xk, yk = layout([[0,1],[1,2],[2,3],[3,0],[0,2],[1,3]], {0: (0,0), 1: (0,1), 2: (1,1)})
+assert(count_crossings(xk, yk, [[0,1],[1,2],[2,3],[3,0],[0,2],[1,3]])[0] == 0)
+
+'''The grid should find the same crossings as testing every pair of edges in a random drawing'''
+rng = np.random.default_rng(11)
+random_edges = as_graph(rng.integers(0, 200, size=(400, 2))).edges
+xr, yr = rng.random(200), rng.random(200)
+i, j = np.triu_indices(len(random_edges), 1)
+e1, e2 = random_edges[i], random_edges[j]
+apart_pairs = (e1[:,0] != e2[:,0]) & (e1[:,0] != e2[:,1]) & (e1[:,1] != e2[:,0]) & (e1[:,1] != e2[:,1])
+segments = np.stack([xr, yr], axis=1)[random_edges]
+every = segments_cross(segments[i], segments[j]) & apart_pairs
+count, pairs = count_crossings(xr, yr, random_edges)
+assert(count == every.sum())
+assert({tuple(p.ravel()) for p in pairs} == {tuple(np.concatenate([p, q])) for p, q in zip(e1[every], e2[every])})
+'''and so should splitting the crowded cell of a small dense cluster into smaller cells'''
+xc = np.r_[rng.random(400), 0.5 + 0.004*rng.random(600)]
+yc = np.r_[rng.random(400), 0.5 + 0.004*rng.random(600)]
+cluster_edges = as_graph(np.r_[rng.integers(0, 400, size=(300, 2)), 400 + rng.integers(0, 600, size=(1500, 2))]).edges
+i, j = np.triu_indices(len(cluster_edges), 1)
+e1, e2 = cluster_edges[i], cluster_edges[j]
+apart_pairs = (e1[:,0] != e2[:,0]) & (e1[:,0] != e2[:,1]) & (e1[:,1] != e2[:,0]) & (e1[:,1] != e2[:,1])
+segments = np.stack([xc, yc], axis=1)[cluster_edges]
+every = segments_cross(segments[i], segments[j], 1e-9*max(np.ptp(xc), np.ptp(yc))**2) & apart_pairs
+assert(count_crossings(xc, yc, cluster_edges)[0] == count_crossings(xc, yc, cluster_edges, depth=0)[0] == every.sum())
+
+'''A star has no crossings, and its edges are never paired up because they all share the hub'''
+angle = rng.random(20000)*2*np.pi
+xs, ys = np.r_[0, np.cos(angle)*rng.random(20000)], np.r_[0, np.sin(angle)*rng.random(20000)]
+start = time.perf_counter()
+assert(count_crossings(xs, ys, [[0, k] for k in range(1, 20001)])[0] == 0)
+print('star with 20000 edges: %.3f s' % (time.perf_counter() - start))
+
+
+# Checking a grid layout with about a million edges, before and after moving one node onto the other side of the grid:
+
+# In[ ]:
+
+
+size = 708
+grid = grid_graph(size, size)
+xg = (np.arange(size*size) % size).astype(float)
+yg = (np.arange(size*size) // size).astype(float)
+print('%d edges' % len(grid.edges))
+
+start = time.perf_counter()
+count, pairs = count_crossings(xg, yg, grid)
+print('%d crossings in %.2f s' % (count, time.perf_counter() - start))
+
+xg[size + 1] = size/2
+start = time.perf_counter()
+count, pairs = count_crossings(xg, yg, grid)
+print('%d crossings in %.2f s' % (count, time.perf_counter() - start))
+
+
+# ## Part 16: Drawing Huge Graphs as Images
+# 
+# Even the `LineCollection` version of `graphplot` stops being useful after a few hundred thousand edges. Matplotlib still has to keep and draw every segment, a saved vector file grows with the number of edges, and the picture turns into a black blob because all of the lines cover each other.
+# 
+# For huge graphs we can draw the picture ourselves as a fixed size grid of pixels instead. `raster_counts` walks along every edge one pixel column at a time, or one pixel row at a time for steep edges, like Bresenham's line drawing algorithm, and counts how many edges pass through each pixel. All of the edges are drawn at once with NumPy, in chunks of about `chunk_steps` pixel steps, so the memory use stays bounded however many edges there are and however long they are. The nodes are counted into a second grid the same way.
+# 
+# Counts can range from one to many thousands, so `shade` maps them to brightness first. With `'log'` the brightness follows the logarithm of the count. With `'eq_hist'` (histogram equalization) each count gets the fraction of nonzero pixels that have at most that count, so every shade of gray is used by about the same number of pixels and both sparse and crowded regions stay visible. `graph_image` combines the edge and node grids into one RGB image, and only that image is handed to matplotlib with `imshow`. The time to draw and the size of the output then depend on the resolution instead of the size of the graph.
+# 
+# `graphplot` switches to the image automatically for graphs with more than `raster_limit` edges, or when called with `raster=True`.
+
+# In[ ]:
+
+
+def raster_grid(x, y, resolution=800):
+    # Square pixels, with the longest side of the drawing spread over `resolution` pixels
+    x0, x1, y0, y1 = np.min(x), np.max(x), np.min(y), np.max(y)
+    pixel = max(x1 - x0, y1 - y0)/(resolution - 1) or 1.0
+    width = int((x1 - x0)/pixel) + 1
+    height = int((y1 - y0)/pixel) + 1
+    return x0, y0, pixel, width, height
+
+
+def raster_counts(x, y, edges, resolution=800, chunk_steps=1<<20):
+    edges = as_graph(edges).edges
+    x0, y0, pixel, width, height = raster_grid(x, y, resolution)
+    # Pixel coordinates, with pixel (i,j) covering [i,i+1) x [j,j+1)
+    u = (np.asarray(x) - x0)/pixel + 0.5
+    v = (np.asarray(y) - y0)/pixel + 0.5
+
+    nodes = np.bincount(np.minimum(v.astype(np.int64), height - 1)*width + np.minimum(u.astype(np.int64), width - 1),
+                        minlength=width*height)
+
+    # Walk along the longer direction of each edge, a and b being the coordinates along and across it
+    steep = np.abs(v[edges[:,1]] - v[edges[:,0]]) > np.abs(u[edges[:,1]] - u[edges[:,0]])
+    a = np.where(steep[:,None], v[edges], u[edges])
+    b = np.where(steep[:,None], u[edges], v[edges])
+    flip = a[:,0] > a[:,1]
+    a[flip] = a[flip, ::-1]
+    b[flip] = b[flip, ::-1]
+    length = a[:,1] - a[:,0]
+    slope = np.divide(b[:,1] - b[:,0], length, out=np.zeros(len(edges)), where=length > 0)
+    first = np.floor(a[:,0]).astype(np.int64)
+    steps = np.floor(a[:,1]).astype(np.int64) - first + 1
+
+    # Chunks of edges with about chunk_steps pixel steps between them, so the memory use stays bounded
+    done = np.cumsum(steps)
+    lines = np.zeros(width*height, dtype=np.int64)
+    k = 0
+    while k < len(edges):
+        stop = max(np.searchsorted(done, done[k] - steps[k] + chunk_steps, side='right'), k + 1)
+        c = slice(k, stop)
+        # One step for each pixel between the two ends, through the middle of the pixel
+        i = np.repeat(np.arange(k, stop), steps[c])
+        along = first[i] + np.arange(len(i)) - np.repeat(np.cumsum(steps[c]) - steps[c], steps[c])
+        across = np.floor(b[i,0] + (np.clip(along + 0.5, a[i,0], a[i,1]) - a[i,0])*slope[i]).astype(np.int64)
+        col = np.minimum(np.where(steep[i], across, along), width - 1)
+        row = np.minimum(np.where(steep[i], along, across), height - 1)
+        lines += np.bincount(row*width + col, minlength=width*height)
+        k = stop
+    return lines.reshape(height, width), nodes.reshape(height, width)
+
+
+def shade(counts, how='eq_hist'):
+    out = np.zeros(counts.shape)
+    hit = counts > 0
+    if not hit.any():
+        return out
+    if how == 'linear':
+        out[hit] = counts[hit]/counts.max()
+    elif how == 'log':
+        out[hit] = np.log1p(counts[hit])/np.log1p(counts.max())
+    elif how == 'eq_hist':
+        values, index, number = np.unique(counts[hit], return_inverse=True, return_counts=True)
+        out[hit] = (np.cumsum(number)/hit.sum())[index.ravel()]
+    else:
+        raise ValueError('unknown shading %r' % how)
+    return out
+
+
+def graph_image(x, y, edges, resolution=800, how='eq_hist', node_color=(0.8, 0.1, 0.1)):
+    lines, nodes = raster_counts(x, y, edges, resolution)
+    x0, y0, pixel, width, height = raster_grid(x, y, resolution)
+
+    # Edges in shades of gray on white, with the nodes blended on top in color
+    gray = 1 - 0.9*shade(lines, how)
+    alpha = 0.5*shade(nodes, how)[:,:,None]
+    image = (1 - alpha)*gray[:,:,None] + alpha*np.array(node_color)
+    extent = (x0 - pixel/2, x0 + (width - 0.5)*pixel, y0 - pixel/2, y0 + (height - 0.5)*pixel)
+    return image, extent
+
+
+def graphplot(x,y,edges,labels=None,label_limit=100,node_size=None,
+              raster=None,raster_limit=200000,resolution=800,how='eq_hist'):
+    edges = as_graph(edges).edges
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if raster is None:
+        raster = len(edges) > raster_limit
+
+    # Display the whole graph as one image of edge and node counts
+    if raster:
+        image, extent = graph_image(x, y, edges, resolution, how)
+        plt.imshow(image, origin='lower', extent=extent, interpolation='nearest')
+        plt.show()
+        return
+
+    if labels is None:
+        labels = len(x) <= label_limit
+    if node_size is None:
+        node_size = 500 if len(x) <= label_limit else 10
+
+    # Display all edges as one collection of line segments [[x_i,y_i],[x_j,y_j]]
+    segments = np.empty((len(edges), 2, 2))
+    segments[:,:,0] = x[edges]
+    segments[:,:,1] = y[edges]
+    ax = plt.gca()
+    ax.add_collection(LineCollection(segments, colors='black',
+                                     linewidths=plt.rcParams['lines.linewidth'], zorder=0))
+
+    # Display nodes as white disks with black borders
+    plt.scatter(x,y,
+                c='white',edgecolors='black',
+                s = node_size,zorder = 1)
+
+    # Label nodes by their index
+    if labels:
+        for i in range(len(x)):
+            ax.annotate(i,[x[i],y[i]],zorder=2,ha='center',va='center')
+
+    ax.autoscale_view()
+    plt.show()
+
+
+# In[ ]:
+
+
+'''A horizontal and a vertical edge across an 11 x 11 image cover one full row and one full column'''
+lines, nodes = raster_counts(np.array([0., 10., 0., 10.]), np.array([0., 0., 10., 10.]), [[0,1],[0,2]], resolution=11)
+assert(lines.shape == (11, 11) and nodes.sum() == 4)
+assert(np.array_equal(lines[0], [2] + [1]*10) and np.array_equal(lines[:,0], [2] + [1]*10))
+assert(lines.sum() == 22 and nodes[0,0] == 1 and nodes[10,10] == 1)
+
+'''A slanted edge touches exactly one pixel in every row or column it runs along, with no gaps'''
+for end in [(3., 7.), (10., 3.), (10., -6.), (-2., 9.)]:
+    lines, nodes = raster_counts(np.array([0., end[0]]), np.array([0., end[1]]), [[0,1]], resolution=11)
+    rows, cols = np.nonzero(lines)
+    steep = abs(end[1]) > abs(end[0])
+    along, across = (rows, cols) if steep else (cols, rows)
+    order = np.argsort(along)
+    assert(lines.max() == 1 and np.array_equal(along[order], np.arange(lines.shape[0] if steep else lines.shape[1])))
+    assert(np.all(np.abs(np.diff(across[order])) <= 1))
+
+'''Every shading keeps empty pixels white and gives more crowded pixels darker shades'''
+counts = np.array([[0, 1, 1, 5], [2, 100, 0, 1]])
+for how in ['linear', 'log', 'eq_hist']:
+    shaded = shade(counts, how)
+    assert(np.all(shaded[counts == 0] == 0) and shaded.max() == 1)
+    assert(np.all(np.diff(shaded.ravel()[np.argsort(counts.ravel())]) >= 0))
+
+'''The image has the same size however many edges there are'''
+xg, yg = layout(grid_graph(60, 60), grid_pins(60, 60))
+image, extent = graph_image(xg, yg, grid_graph(60, 60), resolution=200)
+'''and drawing it in small chunks of pixel steps gives the same counts'''
+assert(np.array_equal(raster_counts(xg, yg, grid_graph(60, 60), 200, chunk_steps=1000)[0],
+                      raster_counts(xg, yg, grid_graph(60, 60), 200)[0]))
+assert(np.array_equal(raster_counts(xg, yg, grid_graph(60, 60), 200, chunk_steps=1)[0],
+                      raster_counts(xg, yg, grid_graph(60, 60), 200)[0]))
+assert(image.shape == (200, 200, 3) and np.allclose(extent, [-29.5/199, 59 + 29.5/199, -29.5/199, 59 + 29.5/199]))
+
+
+# Drawing a million edge grid as an image:
+
+# In[ ]:
+
+
+size = 708
+grid = grid_graph(size, size)
+xg = (np.arange(size*size) % size).astype(float)
+yg = (np.arange(size*size) // size).astype(float)
+xg, yg = xg + 0.3*np.sin(yg/40)*yg, yg + 0.3*np.cos(xg/40)*xg
+
+start = time.perf_counter()
+graphplot(xg, yg, grid)
+print('%d edges: %.2f s' % (len(grid.edges), time.perf_counter() - start))
+
+
+# ## Part 17: A Layout Server
+# 
+# Every program that wants a layout has to import NumPy, SciPy and matplotlib, build the Laplacian and solve from scratch, even when it lays out the same graph over and over. A small server can do that work once and keep the results in memory.
+# 
+# `LayoutServer` holds a `LayoutSession` from Part 11 for every graph registered with it, so the reduced system, and with `method='direct'` its factorization, stay ready between requests. It runs an `asyncio` event loop in a background thread and listens on a Unix socket, or on a local TCP port if no socket path is given. Clients send one JSON request per line and get one JSON reply per line:
+# 
+# - `{"op": "register", "graph": name, "edges": [[i,j], ...], "pins": {i: [x,y], ...}, "method": "direct"}` builds a session.
+# - `{"op": "layout", "graph": name, "pins": {...}}` lays the graph out again, with new pin positions if `pins` is given.
+# - `{"op": "add_edges", ...}` and `{"op": "remove_edges", ...}` change the edges of a graph and lay it out again.
+# - `{"op": "drop", "graph": name}` forgets a graph and `{"op": "list"}` lists the graphs.
+# 
+# Layout replies hold the coordinates in `x` and `y`, as lists, or as base64 encoded float64 bytes if the request asked for `"binary": true`. A request that fails gets `{"ok": false, "error": ...}` back, and a client that hangs up, even before reading its reply, is forgotten. The solves run in a pool of worker threads, so the event loop keeps answering other clients while a large graph is being solved, and SciPy's solvers release the GIL while they run. Requests for the same graph, including registering it again and dropping it, wait for each other on one lock per name, so a session is only ever changed by one request at a time, and each reply is put together before the next request can change the session.
+# 
+# `LayoutClient` is a small blocking client for the same protocol, returning the coordinates as NumPy arrays.
+
+# In[ ]:
+
+
+import asyncio
+import base64
+import json
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+def encode_coordinates(a, binary):
+    if binary:
+        return base64.b64encode(np.ascontiguousarray(a, dtype=np.float64).tobytes()).decode('ascii')
+    return a.tolist()
+
+
+def decode_coordinates(a):
+    if isinstance(a, str):
+        return np.frombuffer(base64.b64decode(a), dtype=np.float64)
+    return np.array(a, dtype=float)
+
+
+class LayoutServer:
+    def __init__(self, max_workers=4):
+        self.sessions = {}
+        self.locks = {}
+        self.clients = {}
+        self.pool = ThreadPoolExecutor(max_workers)
+        self.loop = None
+        self.thread = None
+        self.server = None
+        self.path = None
+
+    def start(self, path=None, host='127.0.0.1', port=0):
+        # Run the event loop in a thread of its own, and return the address to connect to
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        # Allow long request lines, since registering a large graph sends all of its edges on one line
+        if path is None:
+            opening = asyncio.start_server(self.handle, host, port, limit=1 << 30)
+        else:
+            opening = asyncio.start_unix_server(self.handle, path, limit=1 << 30)
+        self.server = asyncio.run_coroutine_threadsafe(opening, self.loop).result()
+        self.path = path
+        return path if path is not None else self.server.sockets[0].getsockname()[:2]
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.pool.shutdown()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def shutdown(self):
+        # Stop listening, hang up on the clients that are still connected and wait for their handlers to finish
+        self.server.close()
+        for writer in self.clients:
+            writer.close()
+        await asyncio.gather(*self.clients.values(), return_exceptions=True)
+
+    async def handle(self, reader, writer):
+        # Answer one JSON request per line until the client hangs up
+        self.clients[writer] = asyncio.current_task()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = await self.dispatch(json.loads(line))
+                except Exception as error:
+                    reply = {'ok': False, 'error': '%s: %s' % (type(error).__name__, error)}
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            # The client hung up before reading its reply
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+
+    async def dispatch(self, request):
+        op = request.get('op')
+        if op == 'list':
+            return {'ok': True, 'graphs': {name: session.n for name, session in self.sessions.items()}}
+        name = request['graph']
+        loop = asyncio.get_running_loop()
+        if op == 'register':
+            # A name keeps its lock when it is registered again or dropped, so requests already waiting on it still queue
+            lock = self.locks.setdefault(name, asyncio.Lock())
+        elif name in self.locks:
+            lock = self.locks[name]
+        else:
+            raise ValueError('no graph named %r' % name)
+
+        async with lock:
+            if op == 'register':
+                pins = {int(i): p for i, p in request['pins'].items()}
+                session = await loop.run_in_executor(self.pool, LayoutSession, request['edges'], pins,
+                                                     request.get('method', 'direct'))
+                self.sessions[name] = session
+                return {'ok': True, 'n': session.n}
+            # The graph may have been dropped while this request waited for the lock
+            if name not in self.sessions:
+                raise ValueError('no graph named %r' % name)
+            if op == 'drop':
+                del self.sessions[name]
+                return {'ok': True}
+
+            session = self.sessions[name]
+            x, y = await loop.run_in_executor(self.pool, self.update, session, request)
+            binary = request.get('binary', False)
+            return {'ok': True, 'x': encode_coordinates(x, binary), 'y': encode_coordinates(y, binary), 'info': session.info}
+
+    def update(self, session, request):
+        # Runs in a worker thread
+        op = request['op']
+        if op == 'add_edges':
+            session.add_edges(request['edges'])
+        elif op == 'remove_edges':
+            session.remove_edges(request['edges'])
+        elif op != 'layout':
+            raise ValueError('unknown op %r' % op)
+        if 'pins' in request:
+            session.move_pins({int(i): p for i, p in request['pins'].items()})
+        return session.layout()
+
+
+class LayoutClient:
+    def __init__(self, address, binary=True):
+        if isinstance(address, str):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.connect(address)
+        self.replies = self.socket.makefile('rb')
+        self.binary = binary
+
+    def call(self, op, **request):
+        request['op'] = op
+        request['binary'] = self.binary
+        if 'pins' in request:
+            request['pins'] = {int(i): np.asarray(p, dtype=float).tolist() for i, p in request['pins'].items()}
+        if 'edges' in request:
+            request['edges'] = np.asarray(as_graph(request['edges']).edges if op == 'register' else request['edges']).tolist()
+        self.socket.sendall(json.dumps(request).encode() + b'\n')
+        reply = json.loads(self.replies.readline())
+        if not reply['ok']:
+            raise RuntimeError(reply['error'])
+        if 'x' in reply:
+            return decode_coordinates(reply['x']), decode_coordinates(reply['y'])
+        return reply
+
+    def register(self, graph, edges, pins, method='direct'):
+        return self.call('register', graph=graph, edges=edges, pins=pins, method=method)['n']
+
+    def layout(self, graph, pins=None):
+        if pins is None:
+            return self.call('layout', graph=graph)
+        return self.call('layout', graph=graph, pins=pins)
+
+    def close(self):
+        self.replies.close()
+        self.socket.close()
+
+
+# In[ ]:
+
+
+import shutil
+import tempfile
+
+'''A server should give the same layouts as calling layout() directly'''
+folder = tempfile.mkdtemp()
+server = LayoutServer()
+address = server.start(os.path.join(folder, 'layout.sock'))
+client = LayoutClient(address)
+
+assert(client.register('part4', edges, {0: (0,0), 1: (0,1), 2: (1,1)}) == 6)
+xs, ys = client.layout('part4')
+assert(np.allclose(xs, x) and np.allclose(ys, y))
+xs, ys = client.layout('part4', {0: (0,0), 1: (0,1), 4: (1,0)})
+xl, yl = layout(edges, {0: (0,0), 1: (0,1), 4: (1,0)})
+assert(np.allclose(xs, xl) and np.allclose(ys, yl))
+
+'''Edge changes are applied to the graph held by the server'''
+client.call('remove_edges', graph='part4', edges=[[5,0]])
+xs, ys = client.call('add_edges', graph='part4', edges=[[3,5],[2,3]], pins={0: (0,0), 1: (0,1), 2: (1,1)})
+xl, yl = layout(changed, {0: (0,0), 1: (0,1), 2: (1,1)})
+assert(np.allclose(xs, xl) and np.allclose(ys, yl))
+
+'''Errors are sent back without stopping the server'''
+for bad in [lambda: client.layout('missing'), lambda: client.call('remove_edges', graph='part4', edges=[[0,5]]),
+            lambda: client.call('rotate', graph='part4')]:
+    try:
+        bad()
+        assert(False)
+    except RuntimeError as error:
+        assert('ValueError' in str(error))
+assert(client.call('list')['graphs'] == {'part4': 6})
+
+'''Registering a graph again or dropping it waits for the other requests on it, which then see the new graph or none'''
+def busy_requests(k):
+    mine, errors = LayoutClient(address), []
+    for step in range(30):
+        try:
+            if (k + step) % 5 == 0:
+                mine.register('busy', grid_graph(20, 20 + k), grid_pins(20, 20 + k))
+            elif (k + step) % 7 == 0:
+                mine.call('drop', graph='busy')
+            else:
+                xs, ys = mine.layout('busy')
+                assert(len(xs) in [400, 420, 440, 460])
+        except RuntimeError as error:
+            errors.append(str(error))
+    mine.close()
+    return errors
+
+with ThreadPoolExecutor(4) as threads:
+    errors = sum(threads.map(busy_requests, range(4)), [])
+assert(all(error == "ValueError: no graph named 'busy'" for error in errors))
+if 'busy' in client.call('list')['graphs']:
+    client.call('drop', graph='busy')
+
+'''A client that hangs up without reading its reply is forgotten'''
+connected = len(server.clients)
+abrupt = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+abrupt.connect(address)
+abrupt.sendall(b'{"op": "layout", "graph": "part4"}\n')
+abrupt.close()
+start = time.perf_counter()
+while len(server.clients) > connected and time.perf_counter() - start < 10:
+    time.sleep(0.01)
+assert(len(server.clients) == connected)
+
+'''The same requests work over TCP with plain JSON lists'''
+other = LayoutServer()
+tcp = LayoutClient(other.start(), binary=False)
+tcp.register('grid', grid_graph(20, 30), grid_pins(20, 30), method='cg')
+xs, ys = tcp.layout('grid')
+assert(np.allclose(xs, np.arange(600) % 30) and np.allclose(ys, np.arange(600) // 30))
+tcp.close()
+other.stop()
+
+
+# Once a graph is registered, laying it out again with new pin positions is a quick round trip, since the factorization is already in memory:
+
+# In[ ]:
+
+
+for name, g, pins in [('part4', edges, {0: (0,0), 1: (0,1), 2: (1,1)}), ('grid', grid_graph(100, 100), grid_pins(100, 100))]:
+    client.register(name, g, pins)
+    client.layout(name, pins)
+    start = time.perf_counter()
+    for k in range(200):
+        client.layout(name, {i: (p[0] + 0.01*k, p[1]) for i, p in pins.items()})
+    print('%-6s %6d nodes: %.3f ms per layout' % (name, as_graph(g).n, (time.perf_counter() - start)/200*1000))
+
+client.close()
+server.stop()
+shutil.rmtree(folder)
+
+
+# ## Part 18: Benchmarks
+# 
+# So far the only checks on this notebook are the small asserts, and the only timings are the few printed along the way. To see how each piece scales, and to notice when a change makes something slower, we need benchmarks over a range of graph sizes.
+# 
+# `benchmark_graphs` holds generators for four kinds of graphs of about n nodes, each returning a `Graph` and its pins:
+# 
+# - `grid`: the square grid from Part 7, with its boundary pinned.
+# - `triangulation`: the Delaunay triangulation of n random points in the unit square, a random planar graph with every face a triangle, with the points on its convex hull pinned where they are.
+# - `tree`: a random tree, where node i is joined to a random earlier node, with its leaves pinned around a circle.
+# - `union`: ten separate pieces of the three kinds above in one graph, which is laid out with `layout_components` from Part 14.
+# 
+# `run_benchmarks` times each stage separately: counting the degrees from the edge list, building the sparse Laplacian, building the pinned system, solving, and rendering with `graphplot` (drawn into an off-screen buffer instead of being shown). Each stage is timed a few times and the fastest time is kept, then run once more under `tracemalloc` for the peak memory it allocates. `tracemalloc` only sees memory allocated through Python and NumPy, not the memory SuperLU allocates inside `splu`. On graphs with at most `check_limit` nodes, the degrees, the Laplacian and the layout are also checked against the Part 3 `deg_reference` and `lap_reference` functions and the dense solve from Part 4.
+# 
+# Every stage gives one record, and with `path` the records are written to a JSON file together with the versions of Python, NumPy and SciPy, so results from different runs and machines can be compared.
+
+# In[ ]:
+
+
+import platform
+import tracemalloc
+import scipy
+from scipy.spatial import Delaunay
+
+def grid_case(n, seed=0):
+    side = max(2, int(round(np.sqrt(n))))
+    return grid_graph(side, side), grid_pins(side, side)
+
+
+def triangulation_case(n, seed=0):
+    points = np.random.default_rng(seed).random((max(n, 4), 2))
+    triangles = Delaunay(points)
+    s = triangles.simplices
+    g = Graph(np.concatenate([s[:,[0,1]], s[:,[1,2]], s[:,[0,2]]]), n=len(points))
+    hull = np.unique(triangles.convex_hull)
+    return g, {int(i): tuple(points[i]) for i in hull}
+
+
+def tree_case(n, seed=0):
+    rng = np.random.default_rng(seed)
+    n = max(n, 3)
+    child = np.arange(1, n)
+    g = Graph(np.stack([child, rng.integers(0, child)], axis=1), n=n)
+    leaves = np.flatnonzero(g.degree == 1)
+    angle = 2*np.pi*np.arange(len(leaves))/len(leaves)
+    return g, {int(i): (np.cos(a), np.sin(a)) for i, a in zip(leaves, angle)}
+
+
+def union_case(n, seed=0, pieces=10):
+    kinds = [grid_case, triangulation_case, tree_case]
+    edges, pins, offset = [], {}, 0
+    for k in range(pieces):
+        g, p = kinds[k % len(kinds)](max(n // pieces, 4), seed + k)
+        edges.append(g.edges.astype(np.int64) + offset)
+        pins.update({i + offset: (xy[0] + 2*k*max(1, np.sqrt(g.n)), xy[1]) for i, xy in p.items()})
+        offset += g.n
+    return Graph(np.concatenate(edges), n=offset), pins
+
+
+benchmark_graphs = {'grid': grid_case, 'triangulation': triangulation_case, 'tree': tree_case, 'union': union_case}
+
+
+def reference_layout(edges, pins):
+    # Part 4: replace the pinned rows of the dense Laplacian with identity rows and solve
+    L = lap_reference(edges)
+    b = np.zeros(len(L))
+    c = np.zeros(len(L))
+    for i, (px, py) in pins.items():
+        L[i] = 0
+        L[i,i] = 1
+        b[i], c[i] = px, py
+    return np.linalg.solve(L, b), np.linalg.solve(L, c)
+
+
+def render(x, y, edges):
+    # Draw into an off-screen buffer instead of showing the figure
+    show = plt.show
+    plt.show = lambda: plt.savefig(io.BytesIO(), format='png')
+    try:
+        plt.figure()
+        graphplot(x, y, edges)
+    finally:
+        plt.show = show
+        plt.close()
+
+
+def measure(stage, repeat=3, budget=1.0):
+    # Fastest of a few runs, or of a single run for slow stages, then the peak memory of one more run
+    times = []
+    while len(times) < repeat and sum(times) < budget:
+        start = time.perf_counter()
+        result = stage()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    stage()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak, result
+
+
+def run_benchmarks(kinds=None, sizes=(10, 100, 1000, 10**4, 10**5, 10**6), method='direct',
+                   check_limit=100, repeat=3, path=None):
+    records = []
+    for kind in kinds or list(benchmark_graphs):
+        for size in sizes:
+            g, pins = benchmark_graphs[kind](size)
+            pinned = pin_arrays(pins)[0]
+            solve = layout_components if kind == 'union' else layout
+
+            def solve_stage():
+                factor_cache.clear()
+                return solve(g, pins, method=method)
+
+            stages = [('degree', lambda: np.bincount(g.edges.ravel(), minlength=g.n)),
+                      ('laplacian', lambda: lap_sparse(g)),
+                      ('pin', lambda: pinned_system(g, pinned)),
+                      ('solve', solve_stage)]
+            results = {}
+            for stage, run in stages:
+                seconds, peak, results[stage] = measure(run, repeat)
+                records.append({'graph': kind, 'size': size, 'nodes': g.n, 'edges': len(g.edges),
+                                'stage': stage, 'seconds': seconds, 'peak_bytes': peak, 'check': None})
+            x, y = results['solve']
+            seconds, peak, result = measure(lambda: render(x, y, g), repeat)
+            records.append({'graph': kind, 'size': size, 'nodes': g.n, 'edges': len(g.edges),
+                            'stage': 'render', 'seconds': seconds, 'peak_bytes': peak, 'check': None})
+
+            # Check small graphs against the reference implementations
+            if g.n <= check_limit:
+                edge_list = g.edges.tolist()
+                checks = {'degree': all(deg_reference(i, edge_list) == results['degree'][i] for i in range(g.n)),
+                          'laplacian': np.allclose(lap_reference(edge_list), results['laplacian'].toarray()),
+                          'solve': np.allclose(np.stack(reference_layout(edge_list, pins)), np.stack(results['solve']))}
+                for record in records[-5:]:
+                    record['check'] = checks.get(record['stage'])
+
+            for record in records[-5:]:
+                print('%-13s %8d nodes %9d edges  %-9s %9.4f s %10.1f MB %s' % (
+                    kind, g.n, len(g.edges), record['stage'], record['seconds'], record['peak_bytes']/2**20,
+                    '' if record['check'] is None else 'ok' if record['check'] else 'MISMATCH'))
+
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump({'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+                       'machine': platform.machine(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'method': method, 'results': records}, f, indent=1)
+    return records
+
+
+# In[ ]:
+
+
+'''The generators should make graphs of about the requested size, with pins in range'''
+for kind, make in benchmark_graphs.items():
+    g, pins = make(400)
+    assert(350 <= g.n <= 450 and min(pins) >= 0 and max(pins) < g.n)
+    assert(len(split_components(g)) == (10 if kind == 'union' else 1))
+
+'''A Delaunay triangulation is planar, so its layout should not have any crossings'''
+g, pins = triangulation_case(300)
+assert(count_crossings(*layout(g, pins), g)[0] == 0)
+
+'''Small benchmarks should agree with the reference implementations and be written out as JSON'''
+path = os.path.join(tempfile.mkdtemp(), 'benchmarks.json')
+records = run_benchmarks(sizes=[10, 60], path=path)
+assert(len(records) == 4*2*5)
+assert(all(r['check'] for r in records if r['stage'] in ('degree', 'laplacian', 'solve')))
+assert(json.load(open(path))['results'] == records)
+
+
+# Running the benchmarks up to a hundred thousand nodes, and keeping the results in `benchmarks.json` next to the notebook (git ignores that file). Passing `sizes` with `10**6` in it, as `run_benchmarks` does by default, goes up to a million nodes, which takes much longer and needs a few gigabytes of memory.
+
+# In[ ]:
+
+
+records = run_benchmarks(sizes=[10, 100, 1000, 10**4, 10**5], path='benchmarks.json')
+
+
 # In[ ]:
 
 